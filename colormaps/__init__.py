@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 # (c) Nelen & Schuurmans, see LICENSE.rst.
 
-from colormaps.core import get  # NOQA
 from colormaps.core import create  # NOQA
 from colormaps.core import registered  # NOQA
 from colormaps.core import DiscreteColormap  # NOQA
 from colormaps.core import GradientColormap  # NOQA
 
+from colormaps.managers import get  # NOQA
 from colormaps.managers import Manager  # NOQA
+
+from colormaps.blend import composite  # NOQA
+from colormaps.files import render_file  # NOQA
+from colormaps.statistics import Statistics  # NOQA
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+"""
+Benchmarks for rendering, labelling and manager loading.
+
+Run with::
+
+    $ python -m colormaps.benchmarks
+
+Store the results as a baseline and compare a later run with it::
+
+    $ python -m colormaps.benchmarks --save baseline.json
+    $ python -m colormaps.benchmarks --compare baseline.json
+
+Everything runs offline on generated data and the builtin collection.
+"""
+
+import argparse
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from colormaps import core
+from colormaps import managers
+
+TILE = 256, 256
+SIZES = {'tile': TILE, 'block': (1024, 1024), 'scene': (4096, 4096)}
+DTYPES = 'u1', 'i2', 'f4', 'f8'
+DENSITIES = 0, 0.1, 1
+
+# relative slowdown reported as a regression when comparing
+THRESHOLD = 0.2
+
+
+def chained(colormap, data, limits=None):
+    """ Return look-up table indices using the original Data chain. """
+    if limits is None and not colormap.free:
+        limits = colormap.limits
+    data = core.Data(data=data, limits=limits)
+    if colormap.interp:
+        data = data.interp(colormap.interp)
+    if colormap.log:
+        data = data.log()
+    data = data.scale()
+    return np.int64(len(colormap) * data.data.clip(0, 1))
+
+
+def fused(colormap, data, limits=None):
+    """ Return look-up table indices using the fused kernel. """
+    return colormap.index(data=data, limits=limits)
+
+
+def baked(colormap, data, limits):
+    """ Return function of look-up table indices using a baked table. """
+    colormap = copy.copy(colormap)  # with a cache of its own
+    colormap.bake = True
+    colormap.get_baked(limits)  # built once, as for repeated calls
+    return lambda: colormap.index(data=data, limits=limits)
+
+
+def measure(function, *args, **kwargs):
+    """ Return wall time in seconds and peak traced memory in bytes. """
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def run(name, function, pixels=0, repeat=3):
+    """
+    Return result dict for a benchmark.
+
+    The time is the best of repeat untraced runs, the peak memory is taken
+    from a separate traced run, because tracing slows down the allocations.
+    """
+    elapsed = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed.append(time.perf_counter() - start)
+    peak = measure(function)[1]
+    seconds = min(elapsed)
+    return {
+        'name': name,
+        'seconds': seconds,
+        'peak': peak,
+        'pixels': pixels,
+        'pixels_per_second': pixels / seconds if pixels and seconds else None,
+    }
+
+
+def make_data(dtype, shape, density, seed=0):
+    """ Return masked array of shape with a fraction density masked. """
+    random = np.random.default_rng(seed)
+    if dtype == 'u1':
+        values = random.integers(0, 256, shape).astype(dtype)
+    elif dtype == 'i2':
+        values = random.integers(-1000, 30000, shape).astype(dtype)
+    else:
+        values = random.uniform(1, 1000, shape).astype(dtype)
+    mask = random.random(shape) < density
+    return np.ma.masked_array(values, mask=mask)
+
+
+def get_colormaps():
+    """
+    Return dict of colormaps covering the rendering paths.
+
+    The log and interp colormaps do not bake, so that they use the kernel.
+    """
+    stops = [(1, (0, 0, 0, 255)), (1000, (255, 255, 255, 255))]
+    interp = [(1, 1), (100, 800), (1000, 1000)]
+    manager = managers.Manager()
+    return {
+        'discrete': manager.get('lc-phy'),
+        'gradient': manager.get('jet'),
+        'log': core.GradientColormap(data=stops, log=True, bake=False),
+        'interp': core.GradientColormap(data=stops, interp=interp,
+                                        bake=False),
+    }
+
+
+def bench_render(sizes=('tile', 'block'), repeat=3):
+    """ Benchmark rendering over colormaps, dtypes, sizes and masks. """
+    results = []
+    colormaps = get_colormaps()
+    for size in sizes:
+        shape = SIZES[size]
+        pixels = shape[0] * shape[1]
+        for dtype in DTYPES:
+            for density in DENSITIES:
+                data = make_data(dtype, shape, density)
+                for kind, colormap in sorted(colormaps.items()):
+                    for limits in None, (5, 900):
+                        name = 'render {} {} {} mask {:.0%} {}'.format(
+                            kind, dtype, size, density,
+                            'free' if limits is None else 'fixed',
+                        )
+                        results.append(run(
+                            name,
+                            lambda: colormap(data, limits=limits),
+                            pixels=pixels,
+                            repeat=repeat,
+                        ))
+    return results
+
+
+def bench_legend(repeat=3):
+    """ Benchmark legend data and labelling. """
+    results = []
+    colormaps = get_colormaps()
+    for kind, colormap in sorted(colormaps.items()):
+        results.append(run(
+            'legend {}'.format(kind),
+            lambda: colormap.get_legend_data(limits=(5, 900), steps=100),
+            repeat=repeat,
+        ))
+    colormap = colormaps['discrete']
+    data = np.random.default_rng(0).integers(0, 60, TILE)
+    results.append(run(
+        'label discrete tile',
+        lambda: colormap.label(data),
+        pixels=data.size,
+        repeat=repeat,
+    ))
+    return results
+
+
+def bench_manager(path=managers.DATA_PATH, repeat=3):
+    """ Benchmark Manager construction and loading all colormaps. """
+    temp = tempfile.mkdtemp()
+    index_path = os.path.join(temp, 'index.json')
+    bundle_path = os.path.join(temp, 'bundle.npy')
+    results = []
+    try:
+        managers.Manager(path, index_path=index_path)
+        managers.Manager(path).compile(bundle_path)
+        for name, kwargs in (('scan', {}),
+                             ('index', {'index_path': index_path}),
+                             ('bundle', {'bundle_path': bundle_path})):
+            results.append(run(
+                'manager init {}'.format(name),
+                lambda: managers.Manager(path, **kwargs),
+                repeat=repeat,
+            ))
+
+            def get_all():
+                manager = managers.Manager(path, **kwargs)
+                for colormap_name in manager.registered:
+                    manager.get(colormap_name)
+
+            results.append(run(
+                'manager get all {}'.format(name), get_all, repeat=repeat,
+            ))
+    finally:
+        shutil.rmtree(temp)
+    return results
+
+
+def bench_kernel(size='block', repeat=3):
+    """ Compare the chained and fused gradient kernels and baked tables. """
+    shape = SIZES[size]
+    data = np.random.default_rng(0).uniform(1, 1000, shape)
+    colormaps = get_colormaps()
+    limits = 5, 900
+    results = []
+    for kind in 'gradient', 'log', 'interp':
+        for function in chained, fused:
+            results.append(run(
+                'kernel {} {} {}'.format(function.__name__, kind, size),
+                lambda: function(colormaps[kind], data, limits=limits),
+                pixels=data.size,
+                repeat=repeat,
+            ))
+        if kind != 'gradient':
+            results.append(run(
+                'kernel baked {} {}'.format(kind, size),
+                baked(colormaps[kind], data, limits=limits),
+                pixels=data.size,
+                repeat=repeat,
+            ))
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Return list of (name, seconds, baseline seconds, ratio, regression).
+
+    :param baseline: list of result dicts of an earlier run
+    :param threshold: relative slowdown considered a regression
+    """
+    seconds = {result['name']: result['seconds'] for result in baseline}
+    comparison = []
+    for result in results:
+        if result['name'] not in seconds:
+            continue
+        ratio = result['seconds'] / seconds[result['name']]
+        comparison.append((result['name'],
+                           result['seconds'],
+                           seconds[result['name']],
+                           ratio,
+                           ratio > 1 + threshold))
+    return comparison
+
+
+def report(results):
+    template = '{name:<48} {time:10.6f} s {peak:8.1f} MiB {rate}'
+    for result in results:
+        rate = result['pixels_per_second']
+        print(template.format(
+            name=result['name'],
+            time=result['seconds'],
+            peak=result['peak'] / 2 ** 20,
+            rate='' if rate is None else '{:8.1f} Mpx/s'.format(rate / 1e6),
+        ))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scene', action='store_true',
+                        help='include full scene sizes (slow)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='PATH',
+                        help='store the results as json baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare the results with a json baseline')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    options = parser.parse_args(args)
+
+    sizes = ('tile', 'block', 'scene') if options.scene else ('tile', 'block')
+    results = (bench_kernel(repeat=options.repeat) +
+               bench_render(sizes=sizes, repeat=options.repeat) +
+               bench_legend(repeat=options.repeat) +
+               bench_manager(repeat=options.repeat))
+    report(results)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'version': 1, 'results': results}, f, indent=2)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        template = '{name:<48} {ratio:6.2f}x {flag}'
+        regressions = 0
+        for name, seconds, previous, ratio, regression in compare(
+            results, baseline, threshold=options.threshold,
+        ):
+            regressions += regression
+            print(template.format(name=name,
+                                  ratio=ratio,
+                                  flag='REGRESSION' if regression else ''))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+"""
+Blending of colormapped layers.
+
+Layers are rendered through premultiplied copies of their colormaps and
+blended block by block in integer arithmetic, so that no full size rgba
+array is built for any layer.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import copy
+
+import numpy as np
+
+from colormaps import core
+
+
+def premultiply(colormap, opacity=1):
+    """
+    Return copy of colormap with a premultiplied look-up table.
+
+    :param colormap: colormap to copy
+    :param opacity: factor for the alpha of all colors, between 0 and 1
+    """
+    lut = colormap.lut.astype('f8')
+    lut[:, 3] *= opacity
+    np.rint(lut[:, 3], out=lut[:, 3])
+    lut[:, :3] *= lut[:, 3:] / 255
+    lut = np.rint(lut).astype('u1')
+
+    premultiplied = copy.copy(colormap)  # with a cache of its own
+    premultiplied.lut = lut
+    premultiplied.rgba = lut[:-1] if len(colormap.rgba) < len(lut) else lut
+    premultiplied.masked = lut[-1]
+    return premultiplied
+
+
+def divide(values):
+    """ Divide uint16 products of two bytes by 255 in-place, rounded. """
+    values += 128
+    values += values >> 8
+    values >>= 8
+    return values
+
+
+def composite(layers, out=None, premultiplied=False, chunk_size=None,
+              max_bytes=core.MAX_BYTES, workers=None):
+    """
+    Return rgba of layers blended over each other, the first at the bottom.
+
+    :param layers: list of (colormap, data, limits, opacity) tuples, where
+        limits and opacity may be left out, defaulting to None and 1.
+    :param out: optional array to put the result in.
+    :param premultiplied: return premultiplied instead of straight rgba.
+    :param chunk_size: number of rows (along the first axis) per block
+    :param max_bytes: temporary memory budget to derive chunk_size from
+    :param workers: number of threads to blend blocks with
+
+    The data of each layer is rendered and masked as by calling its
+    colormap, with limits that depend on the data determined over all of
+    the data. Masked elements get the masked color of their colormap, which
+    is transparent by default.
+    """
+    colormaps, datas, limits = [], [], []
+    for layer in layers:
+        colormap, data, layer_limits, opacity = (tuple(layer) + (None, 1))[:4]
+        colormaps.append(premultiply(colormap, opacity))
+        datas.append(data)
+        limits.append(core.resolve(layer_limits))
+
+    shape = core.split(datas[0])[0].shape
+    for data in datas[1:]:
+        if core.split(data)[0].shape != shape:
+            raise ValueError('All layers should have the same shape.')
+    if out is None:
+        out = np.empty(shape + (4,), 'u1')
+    elif out.shape != shape + (4,):
+        raise ValueError('Expected out of shape {}, got {}'.format(
+            shape + (4,), out.shape,
+        ))
+
+    if not shape:
+        blocks = [Ellipsis]
+    else:
+        if chunk_size is None:
+            chunk_size = shape[0]
+            if workers:
+                chunk_size = -(-chunk_size // workers)
+                max_bytes //= workers
+            row_bytes = core.ELEMENT_BYTES * (len(colormaps) + 1)
+            for size in shape[1:]:
+                row_bytes *= size
+            chunk_size = max(1, min(chunk_size, max_bytes // row_bytes))
+        blocks = [slice(i, i + chunk_size)
+                  for i in range(0, shape[0], chunk_size)]
+    limits = [colormap.get_limits(data, layer_limits, blocks)
+              for colormap, data, layer_limits
+              in zip(colormaps, datas, limits)]
+
+    def blend(block):
+        result = None
+        for colormap, data, layer_limits in zip(colormaps, datas, limits):
+            source = colormap(core.select(data, block), limits=layer_limits)
+            if result is None:
+                result = source.astype('u2')
+                continue
+            # source over result, in premultiplied colors
+            result *= 255 - source[..., 3:].astype('u2')
+            divide(result)
+            result += source
+        if premultiplied:
+            out[block] = result
+            return
+
+        # back to straight colors, rounded
+        alpha = result[..., 3:]
+        result[..., :3] *= 255
+        result[..., :3] += alpha // 2
+        np.floor_divide(result[..., :3], alpha, out=result[..., :3],
+                        where=alpha > 0)
+        out[block] = np.minimum(result, 255, out=result)
+
+    if workers:
+        with ThreadPoolExecutor(workers) as executor:
+            for result in executor.map(blend, blocks):
+                pass  # consuming the results raises any errors
+    else:
+        for block in blocks:
+            blend(block)
+    return out
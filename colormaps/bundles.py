@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+"""
+Bundles of prebuilt colormaps in a single memory mappable file.
+
+A bundle is a .npy file containing a flat uint8 array. It starts with the
+length of a JSON header as an 8 byte integer, followed by the header and
+aligned segments holding the pickled state of each colormap, without its
+arrays, and its arrays. The header has the offsets of the segments, so that
+loading a colormap comes down to unpickling its (small) state and taking
+views on the memory mapped arrays.
+
+Bundles contain pickles, so only load bundles from trusted sources.
+"""
+
+import json
+import pickle
+
+import numpy as np
+
+from colormaps import core
+
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+
+
+def build(path, colormaps, keys):
+    """
+    Write a bundle.
+
+    :param path: path of the .npy file to write
+    :param colormaps: dict of colormaps by name
+    :param keys: list of (key, name) tuples, as Manager.keys
+    """
+    segments = []
+    offset = [0]
+
+    def add(data):
+        """ Return offset of data in the segments. """
+        start = offset[0]
+        padding = -len(data) % ALIGNMENT
+        segments.append(data + b'\0' * padding)
+        offset[0] += len(data) + padding
+        return start
+
+    entries = {}
+    for name, colormap in colormaps.items():
+        state = colormap.__getstate__()
+        arrays = {}
+        for attr, value in list(state.items()):
+            if isinstance(value, np.ndarray):
+                value = np.ascontiguousarray(state.pop(attr))
+                arrays[attr] = [add(value.tobytes()), value.dtype.str,
+                                list(value.shape)]
+        state = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        entries[name] = {
+            'class': colormap.__class__.__name__,
+            'state': [add(state), len(state)],
+            'arrays': arrays,
+        }
+
+    header = json.dumps({
+        'version': BUNDLE_VERSION,
+        'keys': keys,
+        'colormaps': entries,
+    }).encode('utf-8')
+    start = 8 + len(header)
+    start += -start % ALIGNMENT
+    blob = np.zeros(start + offset[0], dtype='u1')
+    blob[:8] = np.frombuffer(np.array(len(header), '<u8').tobytes(), 'u1')
+    blob[8:8 + len(header)] = np.frombuffer(header, 'u1')
+    blob[start:] = np.frombuffer(b''.join(segments), 'u1')
+    np.save(path, blob)
+
+
+class Bundle(object):
+    """ Read-only access to the colormaps in a bundle. """
+    def __repr__(self):
+        template = '<{name}: {path}, {count} colormaps>'
+        return template.format(path=self.path,
+                               count=len(self.names),
+                               name=self.__class__.__name__)
+
+    def __init__(self, path):
+        self.path = path
+        self.blob = np.load(path, mmap_mode='r')
+        length = int(np.frombuffer(self.blob[:8].tobytes(), '<u8')[0])
+        header = json.loads(self.blob[8:8 + length].tobytes().decode('utf-8'))
+        if header['version'] != BUNDLE_VERSION:
+            raise ValueError('Unsupported bundle version.')
+        start = 8 + length
+        self.start = start + -start % ALIGNMENT
+        self.entries = header['colormaps']
+        self.keys = sorted(tuple(k) for k in header['keys'])
+        self.names = sorted(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name):
+        """ Return new colormap from the bundle. """
+        entry = self.entries[name]
+        offset, length = entry['state']
+        offset += self.start
+        state = pickle.loads(self.blob[offset:offset + length].tobytes())
+        for attr, (offset, dtype, shape) in entry['arrays'].items():
+            offset += self.start
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            array = self.blob[offset:offset + size].view(dtype)
+            state[attr] = array.reshape(shape)
+        cls = getattr(core, entry['class'])
+        colormap = cls.__new__(cls)
+        colormap.__setstate__(state)
+        return colormap
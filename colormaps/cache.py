@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+
+from collections import OrderedDict
+import threading
+
+
+class LRU(object):
+    """
+    Least recently used cache, safe to use from multiple threads.
+
+    Items are built at most once at a time: threads requesting a key that is
+    being built wait for that build instead of building it again.
+    """
+    def __repr__(self):
+        template = '<{name}: {length}/{size}, hits {hits}, misses {misses}>'
+        return template.format(length=len(self),
+                               size=self.size,
+                               hits=self.hits,
+                               misses=self.misses,
+                               name=self.__class__.__name__)
+
+    def __init__(self, size=16, nbytes=None, weigh=None):
+        """
+        :param size: maximum number of items in the cache
+        :param nbytes: maximum total weight of the items in the cache
+        :param weigh: callable returning the weight of an item in bytes
+
+        The most recent item is always kept, even if it exceeds nbytes.
+        Items are weighed again on every hit, so that items that grow while
+        cached are accounted for with their current weight.
+        """
+        self.size = size
+        self.nbytes = nbytes
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.weights = {}
+        self.total = 0
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def evict(self):
+        """ Remove least recently used items until within the budget. """
+        while len(self.items) > self.size or (
+            self.nbytes is not None and
+            self.total > self.nbytes and
+            len(self.items) > 1
+        ):
+            key = self.items.popitem(last=False)[0]
+            self.total -= self.weights.pop(key, 0)
+
+    def get(self, key, build):
+        """
+        Return cached item for key, using build() to create it if needed.
+
+        :param key: hashable key
+        :param build: callable without arguments that returns the item
+        """
+        while True:
+            with self.lock:
+                if key in self.items:
+                    self.hits += 1
+                    item = self.items[key]
+                    if self.weigh is None:
+                        self.items.move_to_end(key)
+                    else:
+                        self.store(key, item, self.weigh(item))
+                    return item
+                event = self.pending.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self.pending[key] = threading.Event()
+                    break
+            # another thread is building it, try again when it is done
+            event.wait()
+
+        try:
+            item = build()
+            weight = 0 if self.weigh is None else self.weigh(item)
+        except Exception:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+            raise
+        with self.lock:
+            self.store(key, item, weight)
+            del self.pending[key]
+        event.set()
+        return item
+
+    def store(self, key, item, weight):
+        """ Store item as most recent item, the lock must be held. """
+        self.items[key] = item
+        self.items.move_to_end(key)
+        self.total += weight - self.weights.get(key, 0)
+        self.weights[key] = weight
+        self.evict()
+
+    def put(self, key, item):
+        """ Store or replace the item for key. """
+        weight = 0 if self.weigh is None else self.weigh(item)
+        with self.lock:
+            self.store(key, item, weight)
+
+    def discard(self, key):
+        """ Remove the item for key, if any. """
+        with self.lock:
+            if key in self.items:
+                del self.items[key]
+                self.total -= self.weights.pop(key, 0)
+
+    def keys(self):
+        """ Return list of keys, least recently used first. """
+        with self.lock:
+            return list(self.items)
+
+    def values(self):
+        """ Return list of items, least recently used first. """
+        with self.lock:
+            return list(self.items.values())
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.weights.clear()
+            self.total = 0
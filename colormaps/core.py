@@ -1,15 +1,150 @@
 # -*- coding: utf-8 -*-
 # (c) Nelen & Schuurmans, see LICENSE.rst.
 
+from concurrent.futures import ThreadPoolExecutor
+import json
 import numpy as np
+import os
 import sys
 
+from colormaps import cache
+from colormaps import instrument
+
 MASKED = 0, 0, 0, 0
 INVALID = 0, 0, 0, 0
 
+# rough number of bytes of temporaries per element when rendering, used to
+# translate a memory budget into a number of rows per block
+ELEMENT_BYTES = 32
+MAX_BYTES = 2 ** 26
+
+# discrete colormaps use a dense table when it has at most this many rows or
+# at most a number of rows proportional to the number of values
+DENSE_SIZE = 2 ** 16
+DENSE_RATIO = 16
+
+# number of elements interpolated at a time in single precision
+INTERP_SIZE = 2 ** 16
+
+# initial and maximum number of samples of baked gradient transfer tables
+BAKE_SIZE = 2 ** 12
+BAKE_MAX = 2 ** 20
+
+# number of tables, like the domain lookup tables, cached per colormap
+CACHE_SIZE = 16
+
 registered = {}
 
 
+def split(data):
+    """
+    Return values array and mask array, or None if there is no mask.
+
+    :param data: dict, masked array or anything numpy can make an array of
+    """
+    if isinstance(data, dict):
+        values = np.asarray(data['values'])
+        return values, np.equal(values, data['no_data_value'])
+    if isinstance(data, np.ma.MaskedArray):
+        return data.data, data.mask
+    return np.asarray(data), None
+
+
+def extremes(values, mask=None):
+    """
+    Return minimum and maximum of values, or None if there are none.
+
+    :param values: numpy array
+    :param mask: optional boolean array, True where values are masked
+
+    Reduces without compressing the values, and keeps their dtype.
+    """
+    if not values.size:
+        return None
+    if mask is None or not np.any(mask):
+        return values.min(), values.max()
+    valid = ~mask
+    if not valid.any():
+        return None
+    if values.dtype.kind in 'iu':
+        info = np.iinfo(values.dtype)
+        lower, upper = info.max, info.min
+    else:
+        lower, upper = np.inf, -np.inf
+    return (np.min(values, where=valid, initial=lower),
+            np.max(values, where=valid, initial=upper))
+
+
+def resolve(limits):
+    """
+    Return limits, taking them from a limits source if necessary.
+
+    A limits source is any object having a get_limits() method, such as
+    colormaps.statistics.Statistics.
+    """
+    get_limits = getattr(limits, 'get_limits', None)
+    return limits if get_limits is None else get_limits()
+
+
+def select(data, block):
+    """
+    Return a block of rows of data, preserving its kind.
+
+    :param data: dict, masked array or anything numpy can make an array of
+    :param block: slice along the first axis
+    """
+    if isinstance(data, dict):
+        data = data.copy()
+        data['values'] = np.asarray(data['values'])[block]
+        return data
+    if isinstance(data, np.ma.MaskedArray):
+        return data[block]
+    return np.asarray(data)[block]
+
+
+def blocks(array, factor, fill):
+    """
+    Return view of shape (m, factor, n, factor) on blocks of a 2D array.
+
+    :param array: two dimensional numpy array
+    :param factor: size of the square blocks
+    :param fill: value to pad incomplete blocks at the edges with
+    """
+    rows, cols = array.shape
+    m, n = -(-rows // factor), -(-cols // factor)
+    if (m * factor, n * factor) != array.shape:
+        padded = np.full((m * factor, n * factor), fill, dtype=array.dtype)
+        padded[:rows, :cols] = array
+        array = padded
+    return array.reshape(m, factor, n, factor)
+
+
+def mode(blocks, ignore):
+    """
+    Return the most frequent value per block, ignoring a value.
+
+    :param blocks: array of shape (m, factor, n, factor), see blocks()
+    :param ignore: value not to count, returned for blocks of only that
+
+    Ties go to the lowest value. The values of each block are sorted, so
+    that the length of the run of equal values ending at each position
+    can be found with a cumulative maximum over the run starts.
+    """
+    m, factor, n = blocks.shape[:3]
+    size = factor * factor
+    values = np.sort(blocks.swapaxes(1, 2).reshape(m, n, size), axis=-1)
+    position = np.arange(size)
+    start = np.zeros(values.shape, dtype=np.intp)
+    start[..., 1:] = np.where(
+        values[..., 1:] != values[..., :-1], position[1:], 0,
+    )
+    np.maximum.accumulate(start, axis=-1, out=start)
+    length = position - start
+    length[values == ignore] = -1
+    best = length.argmax(axis=-1)
+    return np.take_along_axis(values, best[..., np.newaxis], axis=-1)[..., 0]
+
+
 class Data(object):
     """
     Convenience wrapper for data.
@@ -66,9 +201,143 @@ class Data(object):
         return self.do(lambda x: (x - offset) / factor)
 
 
+class Labels(object):
+    """
+    Labels per locale, compiled into arrays for vectorized lookup.
+
+    Locales given as a path to a json file are only read when first used.
+    Numeric label keys are compiled into a sorted array for a binary search,
+    or into a dense position table when they are integers that are close
+    together, like the values of a discrete colormap.
+    """
+    def __repr__(self):
+        template = '<{name}: {locales}>'
+        return template.format(locales=', '.join(self.sources),
+                               name=self.__class__.__name__)
+
+    def __getstate__(self):
+        """ Return state with all locales loaded and without tables. """
+        return {'sources': {k: self[k] for k in self.sources}, 'tables': {}}
+
+    def __init__(self, sources):
+        """
+        :param sources: dict of label dicts or json paths, by locale
+        """
+        if isinstance(sources, Labels):
+            sources = sources.sources
+        self.sources = {k: v if isinstance(v, str) else dict(v)
+                        for k, v in sources.items()}
+        self.tables = {}
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __contains__(self, locale):
+        return locale in self.sources
+
+    def __getitem__(self, locale):
+        """ Return label dict for locale. """
+        source = self.sources[locale]
+        if isinstance(source, str):
+            with open(source) as json_file:
+                source = dict(json.load(json_file))
+            self.sources[locale] = source
+        return source
+
+    def compile(self, labels):
+        """ Return keys, values and dense table for labels, or None. """
+        keys = np.array(list(labels))
+        if keys.dtype.kind not in 'biuf' or keys.ndim != 1:
+            return None
+        keys.sort(kind='stable')
+        values = np.empty(len(keys), dtype=object)
+        values[:] = [labels[k] for k in keys.tolist()]
+
+        # dense table with the label or else the value itself per value
+        table = None
+        if keys.dtype.kind in 'iu' and len(keys):
+            size = int(keys[-1]) - int(keys[0]) + 1
+            if size <= max(DENSE_SIZE, DENSE_RATIO * len(keys)):
+                table = np.arange(keys[0], keys[-1] + 1).astype(object)
+                table[keys - keys[0]] = values
+        return keys, values, table
+
+    def get_table(self, locale):
+        if locale not in self.tables:
+            self.tables[locale] = self.compile(self[locale])
+        return self.tables[locale]
+
+    def label(self, data, locale=None):
+        """
+        Return labels for data as a list, or the values without a label.
+
+        :param locale: locale to use, defaults to the first one
+        """
+        if locale not in self.sources:
+            locale = next(iter(self.sources))
+        compiled = self.get_table(locale)
+        data = np.asarray(data)
+        if compiled is None or data.dtype.kind not in 'biuf':
+            labels = self[locale]
+            return np.frompyfunc(lambda x: labels.get(x, x), 1, 1)(
+                data,
+            ).tolist()
+
+        keys, values, table = compiled
+        if not len(keys):
+            return data.tolist()
+
+        if table is not None and data.dtype.kind in 'iu':
+            index = data.astype('i8') - keys[0]
+            inside = (index >= 0) & (index < len(table))
+            if inside.all():
+                return table.take(index.ravel()).reshape(data.shape).tolist()
+            result = data.astype(object)
+            result[inside] = table[index[inside]]
+            return result.tolist()
+
+        found = np.minimum(np.searchsorted(keys, data), len(keys) - 1)
+        with np.errstate(invalid='ignore'):
+            select = keys[found] == data
+        result = data.astype(object)
+        result[select] = values[found[select]]
+        return result.tolist()
+
+
 class BaseColormap(object):
     """ Basic stuff """
     colormap_type = 'base'
+    domain_lookup = False
+
+    def __getstate__(self):
+        """ Return state for pickling and bundling, without the cache. """
+        state = self.__dict__.copy()
+        del state['cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = cache.LRU(CACHE_SIZE)
+
+    @property
+    def nbytes(self):
+        """
+        Return the number of bytes in the arrays of the colormap.
+
+        This includes the tables currently in the cache of the colormap.
+        """
+        arrays = {}  # views on the same array are counted once
+        for value in self.__dict__.values():
+            if isinstance(value, np.ndarray):
+                base = value
+                while isinstance(base.base, np.ndarray):
+                    base = base.base
+                arrays[id(base)] = max(arrays.get(id(base), 0), value.nbytes)
+        tables = sum(t.nbytes for t in self.cache.values())
+        return sum(arrays.values()) + tables
 
     def register(self, name):
         """ Register a colormap for use with get(). """
@@ -78,10 +347,7 @@ class BaseColormap(object):
         """ Return a list of labels. """
         if not self.labels:
             return data
-        labels = self.labels.get(locale, next(iter(self.labels.values())))
-        return np.vectorize(
-            lambda x: labels.get(x, x), otypes=[object],
-        )(data).tolist()
+        return self.labels.label(data, locale=locale)
 
     def __len__(self):
         """
@@ -95,45 +361,472 @@ class BaseColormap(object):
         """
         return len(self.rgba) - 1
 
-    def __call__(self, data, limits=None):
+    def gather(self, index, out=None, packed=False):
         """
-        Return rgba array, handle masked values.
+        Return rgba for look-up table indices.
 
-        :param data: dict('values': np.array, 'no_data_value': number)
+        :param index: A numpy array of indices into the look-up table,
+            which has the masked color as its last entry.
+        :param out: optional array to put the result in.
+        :param packed: gather from a uint32 view of the look-up table.
+        """
+        lut = self.lut.view('u4')[:, 0] if packed else self.lut
+        # indices are always within the table, so skip bounds checking
+        return np.take(lut, index, axis=0, out=out, mode='clip')
+
+    def get_mask(self, data):
+        """
+        Return values and mask.
+
+        Besides the no data value or the mask of the data, non-finite values
+        and values outside the domain of a log colormap are masked. The mask
+        is None if nothing is masked.
+        """
+        values, mask = split(data)
+
+        # also mask non-finite values (-inf, inf, nan), integers are finite
+        if values.dtype.kind not in 'biu':
+            nan_mask = ~np.isfinite(values)
+            mask = nan_mask if mask is None else mask | nan_mask
+
+        # also mask values outside log's domain
+        if getattr(self, "log", False):
+            log_mask = values <= 0
+            mask = log_mask if mask is None else mask | log_mask
+
+        if not np.any(mask):  # np.any(None) returns False
+            return values, None
+        return values, mask
+
+    def get_limits(self, data, limits, blocks, mapper=map):
+        """
+        Return limits to use for all blocks of data.
+
+        :param data: dict, masked array or anything numpy can make an array of
         :param limits: m, n tuple having m <= n.
+        :param blocks: iterable of slices along the first axis of data
+        :param mapper: map-like callable used to visit the blocks
+        """
+        return limits
 
-        The effect of the limits parameter dependes on the colormap type
+    def render_chunked(self, data, limits=None, out=None, packed=False,
+                       chunk_size=None, max_bytes=MAX_BYTES,
+                       workers=None, executor=None):
+        """
+        Return rgba array, rendered in blocks of rows.
+
+        :param data: dict('values': np.array, 'no_data_value': number)
+        :param limits: m, n tuple having m <= n, or a limits source.
+        :param out: optional array to put the result in.
+        :param packed: return one uint32 per element.
+        :param chunk_size: number of rows (along the first axis) per block
+        :param max_bytes: temporary memory budget to derive chunk_size from
+        :param workers: number of threads to render blocks with
+        :param executor: concurrent.futures executor to render blocks with
+
+        Produces the same result as calling the colormap, but the
+        temporary arrays only ever have the size of a single block. Limits
+        that depend on the data, as for free gradients, are determined over
+        the whole array before rendering.
+
+        Numpy releases the GIL for the heavy lifting, so with workers or a
+        (thread pool) executor the blocks are rendered in parallel. The
+        memory budget is then shared among the workers.
+        """
+        if workers is not None and executor is None:
+            with ThreadPoolExecutor(workers) as executor:
+                return self.render_chunked(
+                    data, limits=limits, out=out, packed=packed,
+                    chunk_size=chunk_size, max_bytes=max_bytes,
+                    workers=workers, executor=executor,
+                )
+
+        limits = resolve(limits)
+        values = split(data)[0]
+        if values.ndim == 0:
+            return self(data, limits=limits, out=out, packed=packed)
+
+        shape = values.shape if packed else values.shape + (4,)
+        if out is None:
+            out = np.empty(shape, 'u4' if packed else 'u1')
+        elif out.shape != shape:
+            raise ValueError('Expected out of shape {}, got {}'.format(
+                shape, out.shape,
+            ))
+
+        if chunk_size is None:
+            if executor is not None:
+                # at least a block per worker, all blocks within the budget
+                workers = workers or os.cpu_count() or 1
+                max_bytes = max_bytes // workers
+                chunk_size = -(-len(values) // workers)
+            else:
+                chunk_size = len(values)
+            row_bytes = max(1, values[0].size * ELEMENT_BYTES)
+            chunk_size = max(1, min(chunk_size, max_bytes // row_bytes))
+        blocks = [slice(i, i + chunk_size)
+                  for i in range(0, len(values), chunk_size)]
+
+        def render(block):
+            return self(select(data, block), limits=limits,
+                        out=out[block], packed=packed)
+
+        mapper = map if executor is None else executor.map
+        limits = self.get_limits(data, limits, blocks, mapper=mapper)
+        for result in mapper(render, blocks):
+            pass  # consuming the results raises any errors
+        return out
+
+    def get_frames(self, frames, limits=None, shared=True):
+        """
+        Return frames and the limits to render all of them with.
+
+        :param frames: stack of frames as data of shape (T, ...), or an
+            iterable of frames
+        :param limits: m, n tuple having m <= n, or a limits source.
+        :param shared: determine limits that depend on the data over all
+            frames instead of per frame
+
+        Stacks come back as a list of frames. Iterables come back as they
+        are, unless shared limits have to be determined from them first.
+        """
+        limits = resolve(limits)
+        if isinstance(frames, (np.ndarray, dict)):
+            values = frames['values'] if isinstance(frames, dict) else frames
+            frames = [select(frames, i) for i in range(len(values))]
+        if not shared or limits is not None:
+            return frames, limits
+
+        frames = list(frames)
+        reduced = [self.get_limits(frame, None, [slice(None)])
+                   for frame in frames]
+        reduced = [r for r in reduced if r is not None]
+        if not reduced:
+            return frames, None
+        lower, upper = zip(*reduced)
+        return frames, np.array([min(lower), max(upper)])
+
+    def iter_frames(self, frames, limits=None, shared=True, out=None,
+                    packed=False):
+        """
+        Yield rgba arrays per frame.
+
+        :param frames: stack of frames as data of shape (T, ...), or an
+            iterable of frames
+        :param limits: m, n tuple having m <= n, or a limits source.
+        :param shared: determine limits that depend on the data, as for
+            free gradients, over all frames instead of per frame
+        :param out: optional array to render every frame into, which is
+            then overwritten by the next frame
+        :param packed: yield one uint32 per element.
+
+        Frames from an iterable are rendered as they come, unless shared
+        limits have to be determined from the frames first.
+        """
+        frames, limits = self.get_frames(frames, limits=limits, shared=shared)
+        for frame in frames:
+            yield self(frame, limits=limits, out=out, packed=packed)
+
+    def render_frames(self, frames, limits=None, shared=True, out=None,
+                      packed=False, **kwargs):
+        """
+        Return rgba array of shape (T, ..., 4) for frames.
+
+        :param frames: stack of frames as data of shape (T, ...), or an
+            iterable of frames
+        :param limits: m, n tuple having m <= n, or a limits source.
+        :param shared: determine limits that depend on the data, as for
+            free gradients, over all frames instead of per frame
+        :param out: optional array to put the result in.
+        :param packed: return one uint32 per element.
+
+        With shared limits a stack is rendered as a whole by
+        render_chunked(), to which any remaining keyword arguments are
+        passed. Otherwise the frames are rendered one by one into the
+        result.
+        """
+        if shared and isinstance(frames, (np.ndarray, dict)):
+            return self.render_chunked(
+                frames, limits=limits, out=out, packed=packed, **kwargs
+            )
+
+        frames, limits = self.get_frames(frames, limits=limits, shared=shared)
+        frames = list(frames)
+        if out is None and frames:
+            shape = np.shape(split(frames[0])[0])
+            shape = (len(frames),) + (shape if packed else shape + (4,))
+            out = np.empty(shape, 'u4' if packed else 'u1')
+        for i, frame in enumerate(frames):
+            self(frame, limits=limits, out=out[i], packed=packed)
+        return out
+
+    def lookup(self, data, limits=None, out=None, packed=False,
+               indices=False):
+        """
+        Return rgba array via a table covering the domain of the dtype.
+
+        For data of a small integer dtype, a table with the rgba for every
+        possible value is built by rendering all those values at once.
+        Limits and the no data value are baked into the table, so that
+        rendering is reduced to a single take. Tables are cached per dtype,
+        limits and no data value.
+
+        With indices, the table and the result hold palette indices instead,
+        see render_indices().
         """
         if isinstance(data, dict):
             values = np.asarray(data['values'])
-            mask = np.equal(values, data['no_data_value'])
-        elif isinstance(data, np.ma.MaskedArray):
-            values = data.data
-            mask = data.mask
+            no_data_value = data['no_data_value']
         else:
             values = np.asarray(data)
-            mask = None
+            no_data_value = None
+        mask = getattr(data, 'mask', None)
+
+        # note that free gradients only get no limits when all data is
+        # masked, and then any table does the job
+        limits = self.get_limits(data, limits, [slice(None)])
+        if limits is not None:
+            limits = np.array(limits)
+            key = limits.dtype.str, tuple(limits.tolist())
+        else:
+            key = None
+        name = 'indices' if indices else 'lookup'
+        key = name, values.dtype.str, key, no_data_value
+        unsigned = values.dtype.str.replace('i', 'u')
+        render = self.render_indices if indices else self.render
+
+        def build():
+            size = 2 ** (8 * values.dtype.itemsize)
+            domain = np.arange(size).astype(unsigned).view(values.dtype)
+            if no_data_value is not None:
+                domain = {'values': domain, 'no_data_value': no_data_value}
+            with instrument.stage('table', pixels=size) as stage:
+                table = render(domain, limits=limits)
+                if stage:
+                    stage.update(nbytes=table.nbytes)
+            return table
+
+        def build_masked():
+            # the table with the masked color appended
+            if indices:
+                masked = len(self.get_palette()) - 1
+                dtype = np.promote_types(table.dtype,
+                                         np.min_scalar_type(masked))
+                masked = np.array([masked], dtype)
+            else:
+                masked = self.masked[np.newaxis]
+            return np.concatenate([table, masked])
+
+        if indices:
+            self.check_indices(out)
+        table = self.cache.get(key, build)
+        index = values.view(unsigned)
+        if np.any(mask):
+            # masked elements get an index beyond the table, that is clipped
+            # to the masked entry, so that no boolean scatter is needed
+            table = self.cache.get(key + ('masked',), build_masked)
+            wider = 'u2' if values.dtype.itemsize == 1 else 'u4'
+            shifted = mask.astype(wider)
+            shifted <<= 8 * values.dtype.itemsize
+            shifted |= index
+            index = shifted
+        if packed:
+            table = table.view('u4')[:, 0]
+        return np.take(table, index, axis=0, out=out, mode='clip')
+
+    def render(self, data, limits=None, out=None, packed=False):
+        """
+        Return rgba array, handle masked values.
 
-        # also mask non-finite values (-inf, inf, nan)
-        nan_mask = ~np.isfinite(values)
-        mask = nan_mask if mask is None else mask | nan_mask
+        This is the general rendering path, used by __call__ for data that
+        cannot be rendered with a lookup.
+        """
+        if instrument.enabled:
+            return self.render_stages(
+                data, limits=limits, out=out, packed=packed,
+            )
+        values, mask = self.get_mask(data)
+        if mask is not None and mask.all():
+            return self.fill(values, out=out, packed=packed)
+
+        # masked elements get the index of the masked entry of the table,
+        # so that all elements take the same path
+        index = self.index(values, limits, mask=mask)
+        return self.gather(index, out=out, packed=packed)
+
+    def render_stages(self, data, limits=None, out=None, packed=False):
+        """ Return rgba array like render(), reporting its stages. """
+        with instrument.stage('mask') as stage:
+            values, mask = self.get_mask(data)
+            stage.update(
+                pixels=values.size,
+                masked=0 if mask is None else int(np.count_nonzero(mask)),
+            )
+        if mask is not None and mask.all():
+            return self.fill(values, out=out, packed=packed)
+        with instrument.stage('index', pixels=values.size):
+            index = self.index(values, limits, mask=mask)
+        with instrument.stage('gather', pixels=values.size) as stage:
+            out = self.gather(index, out=out, packed=packed)
+            stage.update(nbytes=out.nbytes)
+        return out
+
+    def overview(self, data, factor=2, limits=None, method=None,
+                 packed=False):
+        """
+        Return rgba of data reduced by factor along both axes.
 
-        # also mask values outside log's domain
-        if getattr(self, "log", False):
-            log_mask = values <= 0
-            mask = mask | log_mask
+        See pyramid(), of which this is a single level.
+        """
+        return self.pyramid(data, levels=1, factor=factor, limits=limits,
+                            method=method, packed=packed)[0]
 
-        if not np.any(mask):  # np.any(None) returns False
-            return self.convert(values, limits)
-        rgba = self.masked * np.ones(values.shape + (4,), 'u1')
-        if not mask.all():
-            rgba[~mask] = self.convert(values[~mask], limits)
-        return rgba
+    def pyramid(self, data, levels, factor=2, limits=None, method=None,
+                packed=False):
+        """
+        Return list of rgba arrays of data reduced by factor, factor ** 2...
+
+        :param data: two dimensional data, see __call__()
+        :param levels: number of levels to return
+        :param factor: reduction factor between levels along both axes
+        :param limits: m, n tuple having m <= n, or a limits source.
+        :param method: reduction method, depends on the colormap type
+        :param packed: return one uint32 per element instead of rgba bytes
+
+        The values are reduced before looking up colors, each level from
+        the previous one, so that no level needs a full resolution lookup.
+        Elements masked by __call__ are left out of the reduction, and a
+        reduced element is only masked when all its elements are masked.
+        Incomplete blocks at the edges are reduced over the elements they
+        have. Limits that depend on the data are determined at full
+        resolution, so all levels use the same limits.
+        """
+        limits = resolve(limits)
+        values, mask = self.get_mask(data)
+        if values.ndim != 2:
+            raise ValueError('Overviews need two dimensional data.')
+        limits = self.get_limits(data, limits, [slice(None)])
+        state = self.prepare_overview(values, mask, limits, method=method)
+        result = []
+        for level in range(levels):
+            state = self.reduce_overview(state, factor)
+            result.append(self.render_overview(state, limits, packed=packed))
+        return result
+
+    def get_palette(self):
+        """ Return rgba palette for palette indices, masked color last. """
+        return self.lut
+
+    def to_palette(self, index):
+        """ Return palette indices for look-up table indices. """
+        return index
+
+    def check_indices(self, out):
+        """ Raise ValueError if out cannot hold all palette indices. """
+        if out is None:
+            return
+        dtype = np.min_scalar_type(len(self.get_palette()) - 1)
+        if not np.can_cast(dtype, out.dtype):
+            template = 'Expected out of a dtype holding {}, got {}'
+            raise ValueError(template.format(dtype, out.dtype))
+
+    def render_indices(self, data, limits=None, out=None):
+        """
+        Return palette indices, masked elements get the last index.
+
+        :param data: dict('values': np.array, 'no_data_value': number)
+        :param limits: m, n tuple having m <= n.
+        :param out: optional array to put the result in, of a dtype that
+            holds all palette indices, including the masked one.
+
+        The indices are of the smallest unsigned dtype that fits. That is
+        uint8 when the palette has at most 256 colors, or when it has 257
+        and nothing is masked, so that the masked color is not used. Taking
+        the palette at the indices gives the same rgba as render().
+        """
+        self.check_indices(out)
+        values, mask = self.get_mask(data)
+        index = self.to_palette(self.index(values, limits, mask=mask))
+        if out is None:
+            size = len(self.get_palette()) - (mask is None)
+            dtype = np.min_scalar_type(size - 1)
+            return np.asarray(index).astype(dtype)
+        out[...] = index
+        return out
+
+    def fill(self, values, out=None, packed=False):
+        """ Return rgba array of the masked color for all values. """
+        if out is None:
+            shape = values.shape if packed else values.shape + (4,)
+            out = np.empty(shape, 'u4' if packed else 'u1')
+        out[...] = self.masked.view('u4')[0] if packed else self.masked
+        return out
+
+    def __call__(self, data, limits=None, out=None, packed=False,
+                 indices=False):
+        """
+        Return rgba array, handle masked values.
+
+        :param data: dict('values': np.array, 'no_data_value': number)
+        :param limits: m, n tuple having m <= n, or a limits source.
+        :param out: optional uint8 array of shape data.shape + (4,) to put
+            the result in, for example a reused frame buffer.
+        :param packed: return a uint32 array of shape data.shape, with
+            each element holding the four rgba bytes. Use .view('u1') on a
+            contiguous result to get the usual rgba layout.
+        :param indices: return a tuple of an array of palette indices of
+            shape data.shape and the rgba palette instead, for example for
+            paletted images. An out array should then be of shape
+            data.shape and hold all palette indices, or ValueError is
+            raised. See render_indices(). For uint8 indices the palette has
+            at most 256 colors, leaving out the masked color if needed.
+
+        The effect of the limits parameter dependes on the colormap type
+        """
+        if packed and indices:
+            raise ValueError('Indices cannot be packed.')
+        limits = resolve(limits)
+        values = np.asarray(data['values'] if isinstance(data, dict) else data)
+
+        shape = values.shape if packed or indices else values.shape + (4,)
+        if out is not None and out.shape != shape:
+            raise ValueError('Expected out of shape {}, got {}'.format(
+                shape, out.shape,
+            ))
+
+        # a domain lookup pays off when there are at least as many values
+        # as there are entries in the table, and when its table can be
+        # reused, that is when the limits do not depend on the data
+        if (self.domain_lookup and
+                (limits is not None or not getattr(self, 'free', False)) and
+                values.dtype.kind in 'iu' and
+                values.dtype.itemsize <= 2 and
+                values.size >= 2 ** (8 * values.dtype.itemsize)):
+            render = self.lookup
+        else:
+            render = self.render
+        if indices:
+            if render == self.lookup:
+                index = self.lookup(data, limits=limits, out=out, indices=True)
+            else:
+                index = self.render_indices(data, limits=limits, out=out)
+            palette = self.get_palette()
+            if index.dtype == 'u1' and len(palette) > 256:
+                palette = palette[:256]  # nothing masked
+            return index, palette
+        if not instrument.enabled:
+            return render(data, limits=limits, out=out, packed=packed)
+        with instrument.stage('call',
+                              kind=self.colormap_type,
+                              path=render.__name__,
+                              pixels=values.size):
+            return render(data, limits=limits, out=out, packed=packed)
 
 
 class DiscreteColormap(BaseColormap):
     """ Colormap for classified data. """
     colormap_type = 'discrete'
+    domain_lookup = True
 
     def __repr__(self):
         template = '<{name}: size {size}, limits {lower}-{upper}>'
@@ -142,28 +835,61 @@ class DiscreteColormap(BaseColormap):
                                upper=self.limits[1],
                                name=self.__class__.__name__)
 
+    def __getstate__(self):
+        state = super(DiscreteColormap, self).__getstate__()
+        del state['lut']  # same as rgba
+        return state
+
+    def __setstate__(self, state):
+        super(DiscreteColormap, self).__setstate__(state)
+        self.lut = self.rgba
+
     def __init__(self, data, masked=MASKED, invalid=INVALID, labels={}):
         """
         Build the look-up table.
+
+        Usually the table is dense, having a row for every value from zero
+        (or the lowest value, if negative) up to the highest value. If that
+        would make the table too big compared to the number of values, a
+        compact table with a row per value is built instead, and values are
+        looked up by a binary search over the sorted values.
         """
         values, colors = zip(*data)
 
         self.limits = min(values), max(values)
         self.masked = np.array(masked, 'u1')
         self.invalid = np.array(invalid, 'u1')
-        self.labels = {k: dict(v) for k, v in labels.items()}
-        self.rgba = self.invalid * np.ones((self.limits[1] + 2, 4), dtype='u1')
+        self.labels = Labels(labels)
+        self.cache = cache.LRU(CACHE_SIZE)
+
+        values = np.array(values, 'i8')
+        colors = np.array(colors, 'u1')
+        self.offset = min(0, self.limits[0])
+        size = self.limits[1] - self.offset + 1
+        if size <= max(DENSE_SIZE, DENSE_RATIO * len(values)):
+            self.codes = None
+            self.rgba = np.empty((size + 1, 4), dtype='u1')
+            self.rgba[:] = self.invalid
+            self.rgba[values - self.offset] = colors
+        else:
+            # the last occurrence of a value wins, as in the dense table
+            codes, index = np.unique(values[::-1], return_index=True)
+            self.codes = codes
+            self.rgba = np.empty((len(codes) + 2, 4), dtype='u1')
+            self.rgba[:-2] = colors[::-1][index]
+            self.rgba[-2] = self.invalid
         self.rgba[-1] = self.masked
-        self.rgba[np.array(values)] = colors
+        self.lut = self.rgba
 
-    def convert(self, data, limits):
-        """"
-        Return rgba.
+    def index(self, data, limits, mask=None):
+        """
+        Return look-up table indices for data.
 
-        :param data: A numpy array, not masked.
+        :param data: A numpy array.
         :param limits: m, n tuple having m <= n.
+        :param mask: optional boolean array, True for masked elements
 
-        Values outside the limits will be colored with the masked color,
+        Values outside the limits will get the index of the masked color,
         even if a value was given during the colormap initialization.
         """
         # tighten limits to colormap
@@ -173,14 +899,83 @@ class DiscreteColormap(BaseColormap):
             limits = np.array(limits).clip(*self.limits)
 
         # mask data outside limits
-        index = data.astype(np.int64)
+        with np.errstate(invalid='ignore'):  # masked values may be nan
+            index = data.astype(np.int64)
         out_of_bounds = (index < limits[0]) | (index > limits[1])
+        if mask is not None:
+            out_of_bounds |= mask
+        if self.codes is not None:
+            found = np.searchsorted(self.codes, index)
+            found = np.minimum(found, len(self.codes) - 1)
+            index = np.where(self.codes[found] == index, found, len(self) - 1)
+        elif self.offset:
+            index -= self.offset
         if index.ndim == 0:  # these cannot be indexed
             if out_of_bounds:
-                index = self.limits[1] + 1
+                index = len(self)
         else:
-            index[out_of_bounds] = self.limits[1] + 1
-        return self.rgba[index]
+            index[out_of_bounds] = len(self)
+        return index
+
+    def compact(self):
+        """
+        Return palette and look-up table to palette index table.
+
+        The palette has the distinct colors of the codes and the invalid
+        color, in order of appearance, and the masked color last.
+        """
+        colors = self.rgba[:-1].view('u4')[:, 0]
+        unique, first, inverse = np.unique(
+            colors, return_index=True, return_inverse=True,
+        )
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        palette = np.concatenate([self.rgba[first[order]], self.rgba[-1:]])
+        remap = np.append(rank[inverse], len(unique))
+        return palette, remap.astype(np.min_scalar_type(len(unique)))
+
+    def get_palette(self):
+        """ Return compact rgba palette, masked color last. """
+        return self.cache.get('palette', lambda: self.compact()[0])
+
+    def to_palette(self, index):
+        """ Return palette indices for look-up table indices. """
+        remap = self.cache.get('remap', lambda: self.compact()[1])
+        return np.take(remap, index, mode='clip')
+
+    def prepare_overview(self, values, mask, limits, method=None):
+        """ Return look-up table indices to reduce by mode. """
+        if method not in (None, 'mode'):
+            raise ValueError('Unknown method {!r}'.format(method))
+        return self.index(values, limits, mask=mask)
+
+    def reduce_overview(self, index, factor):
+        """
+        Return the most frequent index per block, if not masked.
+
+        Beyond the first level this is the mode of the modes of the previous
+        level, which approximates the mode over all the elements.
+        """
+        return mode(blocks(index, factor, len(self)), ignore=len(self))
+
+    def render_overview(self, index, limits, packed=False):
+        return self.gather(index, packed=packed)
+
+    def convert(self, data, limits, out=None, packed=False):
+        """"
+        Return rgba.
+
+        :param data: A numpy array, not masked.
+        :param limits: m, n tuple having m <= n.
+        :param out: optional array to put the result in.
+        :param packed: return uint32 instead of rgba bytes.
+
+        Values outside the limits will be colored with the masked color,
+        even if a value was given during the colormap initialization.
+        """
+        index = self.index(data=data, limits=limits)
+        return self.gather(index, out=out, packed=packed)
 
     def get_legend_data(self, limits, steps):
         """For a discrete map, we ignore 'steps'."""
@@ -190,14 +985,106 @@ class DiscreteColormap(BaseColormap):
             # tighten custom limits to colormap
             limits = np.array(limits).clip(*self.limits)
 
-        return np.in1d(
-            self.rgba.view('u4')[int(limits[0]):int(limits[1]) + 1],
-            self.invalid.view('u4'), invert=True,
-        ).nonzero()[0] + limits[0]
+        if self.codes is None:
+            lower = int(limits[0]) - self.offset
+            upper = int(limits[1]) - self.offset
+            codes = np.arange(lower, upper + 1) + self.offset
+            rgba = self.rgba[lower:upper + 1]
+        else:
+            codes = self.codes
+            rgba = self.rgba[:-2]
+            index = (codes >= limits[0]) & (codes <= limits[1])
+            codes, rgba = codes[index], rgba[index]
+
+        return codes[np.isin(
+            rgba.view('u4')[:, 0], self.invalid.view('u4'), invert=True,
+        )]
+
+
+class Baked(object):
+    """
+    Transfer table from data to look-up table indices of a gradient.
+
+    The colormaps' processing of data (clip, interp, log and scale) for
+    fixed limits is a known function, that is sampled once at equidistant
+    points between the limits. For log colormaps without interp, the points
+    are equidistant in log space, so that the samples follow the colormap
+    over any number of decades. Data is then converted by locating the
+    nearest sample, which only takes an affine transformation (after a log)
+    and a take.
+
+    The number of samples is doubled until neighbouring samples differ by
+    at most one index, or until BAKE_MAX samples. The error, the largest
+    difference between neighbouring samples, is stored and bounds the
+    difference with the exact indices when the processing is monotone, as
+    it is unless the interp has a non-monotone y. A table with an error
+    above one is not used, and dropped.
+    """
+    def __repr__(self):
+        template = '<{name}: size {size}, limits {lower} - {upper}, error {e}>'
+        return template.format(size=self.size,
+                               lower=self.limits[0],
+                               upper=self.limits[1],
+                               e=self.error,
+                               name=self.__class__.__name__)
+
+    def __init__(self, colormap, limits):
+        """
+        :param colormap: a GradientColormap
+        :param limits: m, n array having m < n.
+        """
+        self.limits = limits
+        self.dtype = 'f4' if colormap.precision == 'float32' else 'f8'
+        lower, upper = sorted(limits.tolist())
+        self.log = colormap.log and not colormap.interp and lower > 0
+        if self.log:
+            start, stop = np.log(lower), np.log(upper)
+        else:
+            start, stop = lower, upper
+
+        size = BAKE_SIZE
+        while True:
+            samples = np.linspace(start, stop, size)
+            if self.log:
+                np.exp(samples, out=samples)
+                samples[[0, -1]] = lower, upper  # exactly
+            scratch = colormap.normalize(data=samples, limits=limits)
+            scratch *= len(colormap)
+            table = scratch.astype(np.int64)
+            self.error = np.abs(np.diff(table)).max()
+            if self.error <= 1 or size >= BAKE_MAX:
+                break
+            size *= 2
+
+        dtype = 'u2' if len(colormap.lut) <= 2 ** 16 else 'i8'
+        self.table = table.astype(dtype) if self.error <= 1 else None
+        self.size = size
+        self.lower = lower
+        self.upper = upper
+        self.start = start
+        self.factor = (size - 1) / (stop - start)
+
+    @property
+    def nbytes(self):
+        return 0 if self.table is None else self.table.nbytes
+
+    def __call__(self, data, mask=None):
+        """ Return look-up table indices for data. """
+        scratch = np.array(data, dtype=self.dtype)
+        if mask is not None:
+            np.copyto(scratch, self.lower, where=mask)
+        np.clip(scratch, self.lower, self.upper, out=scratch)
+        if self.log:
+            np.log(scratch, out=scratch)
+        scratch -= self.start
+        scratch *= self.factor
+        np.rint(scratch, out=scratch)
+        return np.take(self.table, scratch.astype(np.intp), mode='clip')
 
 
 class GradientColormap(BaseColormap):
     colormap_type = 'gradient'
+    domain_lookup = True
 
     def __repr__(self):
         template = ('<{name}: size {size}, '
@@ -218,19 +1105,173 @@ class GradientColormap(BaseColormap):
 
         Returned data is clipped between 0 and 1.
         """
-        data = Data(data=data, limits=limits)
+        return self.normalize(data=data, limits=limits)
+
+    def normalize(self, data, limits=None, mask=None):
+        """
+        Return data scaled to span (0, 1) in a single scratch array.
+
+        This produces the same result as chaining the clip, interp, log and
+        scale steps of the Data class, but it applies them in-place to one
+        copy of the data instead of allocating a new array for every step.
+        The dtype of the scratch array follows the type promotions of that
+        chain, so that the results are bit-identical.
+
+        Masked elements, if a mask is given, are set to the lower limit
+        before processing, their results are meaningless.
+
+        With float32 precision, the scratch array and all intermediates are
+        single precision instead. Resulting indices then differ by at most
+        one entry from those of the double precision path, provided float32
+        resolves the data well compared to the width of a table entry.
+        """
+        data = np.asarray(data)
+        if limits is None:
+            limits = np.array([data.min(), data.max()])
+            dtype = data.dtype
+        else:
+            if limits[1] < limits[0]:
+                limits = limits[::-1]
+            limits = np.array(limits)
+            dtype = np.result_type(data.dtype, limits.dtype)
+
+        if self.precision == 'float32':
+            dtype = np.dtype('f4')
+        elif self.interp:
+            dtype = np.dtype('f8')
+        elif self.log:
+            dtype = np.result_type(dtype, np.float16)
+        elif dtype.kind != 'f':
+            dtype = np.dtype('f8')
+
+        scratch = np.array(data, dtype=dtype)
+        limits = limits.astype(dtype)
+        if mask is not None:
+            np.copyto(scratch, limits[0], where=mask)
+        np.clip(scratch, limits[0], limits[1], out=scratch)
+
+        if self.interp and dtype == 'f8':
+            # np.interp has no out parameter, its result becomes the scratch
+            scratch = np.asarray(np.interp(scratch, *self.interp))
+            limits = np.interp(limits, *self.interp)
+        elif self.interp:
+            # np.interp always returns doubles, so interpolate in blocks to
+            # avoid a full size double precision temporary
+            flat = scratch.reshape(-1)
+            for i in range(0, flat.size, INTERP_SIZE):
+                block = slice(i, i + INTERP_SIZE)
+                flat[block] = np.interp(flat[block], *self.interp)
+            limits = np.interp(limits, *self.interp).astype(dtype)
         if self.interp:
-            data = data.interp(self.interp)
+            if limits[1] < limits[0]:
+                limits = limits[::-1]
+            np.clip(scratch, limits[0], limits[1], out=scratch)
+
         if self.log:
-            data = data.log()
-        data = data.scale()
+            np.log(scratch, out=scratch)
+            limits = np.log(limits)
+
+        factor = limits[1] - limits[0]
+        if factor == 0:
+            # single value, return 0.5
+            scratch[...] = 0.5
+        else:
+            scratch -= limits[0]
+            scratch /= factor
+
+        return np.clip(scratch, 0, 1, out=scratch)
+
+    def index(self, data, limits, mask=None):
+        """
+        Return look-up table indices for data.
+
+        :param data: A numpy array.
+        :param limits: m, n tuple having m <= n.
+        :param mask: optional boolean array, True for masked elements
+
+        Masked elements get the index of the masked color.
+
+        With bake, floating point data is converted by log or interp
+        colormaps through a baked transfer table, if the limits do not
+        depend on the data and the table is exact to within one entry.
+        """
+        if limits is None:
+            if not self.free:
+                limits = self.limits
+            elif mask is not None:
+                limits = extremes(data, mask)
+                if limits is None:  # everything is masked
+                    return np.full(data.shape, len(self.lut) - 1, 'i8')
+                limits = np.array(limits)
+            fixed = not self.free
+        else:
+            fixed = True
+
+        data = np.asarray(data)
+        baked = None
+        if (fixed and self.bake and
+                (self.log or self.interp) and
+                data.dtype.kind == 'f' and
+                limits[0] != limits[1]):
+            baked = self.get_baked(limits)
+        if baked is not None and baked.table is not None:
+            index = baked(data, mask=mask)
+        else:
+            scratch = self.normalize(data=data, limits=limits, mask=mask)
+
+            # data is between 0 and 1, and self.rgba deliberately has a
+            # repeated last element to handle data elements that have the
+            # value 1
+            scratch *= len(self)
+            index = scratch.astype(np.int64)
+
+        if mask is not None:
+            np.copyto(index, len(self.lut) - 1, where=mask)
+        return index
+
+    def get_baked(self, limits):
+        """
+        Return cached transfer table for limits.
+
+        :param limits: m, n tuple having m <= n.
+        """
+        limits = np.array(limits)
+        key = 'baked', limits.dtype.str, tuple(limits.tolist())
+        return self.cache.get(key, lambda: Baked(self, limits))
+
+    def get_limits(self, data, limits, blocks, mapper=map):
+        """
+        Return limits to use for all blocks of data.
+
+        For free gradients without limits, these are the limits of the
+        unmasked values over all blocks.
+        """
+        if limits is not None or not self.free:
+            return limits
+
+        def reduce(block):
+            return extremes(*self.get_mask(select(data, block)))
 
-        # return the clipped array
-        return data.data.clip(0, 1)
+        reduced = [r for r in mapper(reduce, blocks) if r is not None]
+        if not reduced:
+            return None
+        lower, upper = zip(*reduced)
+        # keep the dtype of the data, as the unchunked case does
+        return np.array([min(lower), max(upper)])
+
+    def __getstate__(self):
+        state = super(GradientColormap, self).__getstate__()
+        del state['rgba']  # a view on lut
+        return state
+
+    def __setstate__(self, state):
+        super(GradientColormap, self).__setstate__(state)
+        self.rgba = self.lut[:-1]
 
     def __init__(self, data,
                  size=256, log=False, free=True,
-                 interp=None, masked=MASKED, labels={}):
+                 interp=None, masked=MASKED, labels={},
+                 precision='float64', bake=False):
         """
         Build the look-up table.
 
@@ -240,15 +1281,23 @@ class GradientColormap(BaseColormap):
         :param log: use a log scale whenever appropriate
         :param interp: [(x1, y1), (x2, y2), ...]
         :param masked: rgba tuple to use as masked color
+        :param precision: 'float64' or 'float32', for the processing of data
+        :param bake: use baked transfer tables for log and interp colormaps,
+            see Baked. Indices then differ by at most one entry from the
+            exact ones, for data of any size.
         """
+        if precision not in ('float64', 'float32'):
+            raise ValueError('Unknown precision {!r}'.format(precision))
         values, colors = zip(*data)
 
         # options
         self.log = log
         self.free = free
+        self.bake = bake
         self.masked = np.array(masked, 'u1')
-        self.labels = {k: dict(v) for k, v in labels.items()}
+        self.labels = Labels(labels)
         self.limits = min(values), max(values)
+        self.cache = cache.LRU(CACHE_SIZE)
 
         # store interpolation inputs
         if interp is not None:
@@ -259,22 +1308,82 @@ class GradientColormap(BaseColormap):
         else:
             self.interp = None
 
-        # now the color entries
+        # now the color entries, always in double precision
+        self.precision = 'float64'
         stops = self.process(data=values)
         values = np.arange(size) / (size - 1)
+        self.precision = precision
 
-        # build the color table
-        self.rgba = np.empty((size + 1, 4), 'u1')
+        # build the color table, with an extra masked entry for lookups
+        self.lut = np.empty((size + 2, 4), 'u1')
+        self.lut[-1] = self.masked
+        self.rgba = self.lut[:-1]
         for i, c in enumerate(zip(*colors)):
             self.rgba[: -1, i] = np.interp(values, stops, c)
         self.rgba[-1, :] = self.rgba[-2, :]
 
-    def convert(self, data, limits):
+    def prepare_overview(self, values, mask, limits, method=None):
+        """
+        Return state for reduction by 'mean', 'min' or 'max'.
+
+        The mean is reduced by sum and count of the valid values, so that
+        it is exact for every level. For the minimum and the maximum masked
+        values are replaced by a value that does not affect the result.
+        """
+        method = method or 'mean'
+        if mask is None:
+            mask = np.zeros(values.shape, dtype=bool)
+        if method == 'mean':
+            total = np.where(mask, 0, values).astype('f8')
+            return method, total, (~mask).astype('i8'), 0
+        if method not in ('min', 'max'):
+            raise ValueError('Unknown method {!r}'.format(method))
+        if values.dtype.kind in 'iu':
+            info = np.iinfo(values.dtype)
+            fill = info.max if method == 'min' else info.min
+        else:
+            fill = np.inf if method == 'min' else -np.inf
+        return method, np.where(mask, fill, values), mask, fill
+
+    def reduce_overview(self, state, factor):
+        method, values, other, fill = state
+        if method == 'mean':
+            values = blocks(values, factor, 0).sum(axis=(1, 3))
+            count = blocks(other, factor, 0).sum(axis=(1, 3))
+            return method, values, count, fill
+        reduce = np.min if method == 'min' else np.max
+        values = reduce(blocks(values, factor, fill), axis=(1, 3))
+        mask = blocks(other, factor, True).all(axis=(1, 3))
+        return method, values, mask, fill
+
+    def render_overview(self, state, limits, packed=False):
+        method, values, other, fill = state
+        if method == 'mean':
+            mask = other == 0
+            values = values / np.maximum(other, 1)
+        else:
+            mask = other
+        index = self.index(values, limits, mask=mask if mask.any() else None)
+        return self.gather(index, packed=packed)
+
+    def get_palette(self):
+        """ Return rgba palette, without the repeated last color. """
+        return np.concatenate([self.lut[:-2], self.lut[-1:]])
+
+    def to_palette(self, index):
+        """ Return palette indices for look-up table indices, in-place. """
+        # the repeated last color and the masked color shift down one
+        np.subtract(index, index >= len(self), out=index, casting='unsafe')
+        return index
+
+    def convert(self, data, limits, out=None, packed=False):
         """
         Return rgba.
 
         :param data: A numpy array, not masked.
         :param limits: m, n tuple having m <= n.
+        :param out: optional array to put the result in.
+        :param packed: return uint32 instead of rgba bytes.
 
         If limits are given, input is scaled such that values between
         limits span the colormap. Values outside are colored according
@@ -284,14 +1393,8 @@ class GradientColormap(BaseColormap):
         colormap is 'free' or else from the colormap initialization
         values.
         """
-        if limits is None and not self.free:
-            limits = self.limits
-
-        data = self.process(data=data, limits=limits)
-
-        # data is between 0 and 1, and self.rgba deliberately has a repeated
-        # last element to handle data elements that have the value 1
-        return self.rgba[np.int64(len(self) * data)]
+        index = self.index(data=data, limits=limits)
+        return self.gather(index, out=out, packed=packed)
 
     def get_legend_data(self, limits, steps):
         """We need to interpolate the range, then take a linear range between
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+
+import numpy as np
+
+from colormaps import core
+from colormaps import managers
+
+
+def open_source(path, dtype=None, shape=None):
+    """ Return read-only memory map of a .npy or a raw file. """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if dtype is None or shape is None:
+        raise ValueError('Raw files need a dtype and a shape.')
+    return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+
+
+def open_target(path, dtype, shape):
+    """ Return writable memory map of a new .npy or raw file. """
+    if path.endswith('.npy'):
+        return np.lib.format.open_memmap(
+            path, mode='w+', dtype=dtype, shape=shape,
+        )
+    return np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
+
+def render_file(colormap, src, dst, dtype=None, shape=None,
+                no_data_value=None, limits=None, packed=False, **kwargs):
+    """
+    Render the data in file src to an rgba file dst.
+
+    :param colormap: colormap or name of a colormap
+    :param src: path to a .npy file or a raw file of values
+    :param dst: path to a .npy file or a raw file to write rgba to
+    :param dtype: dtype of a raw src
+    :param shape: shape of a raw src
+    :param no_data_value: value to be masked
+    :param limits: m, n tuple having m <= n.
+    :param packed: write one uint32 per element instead of rgba bytes
+
+    Both files are memory mapped and the rendering is done blockwise by
+    render_chunked(), to which any remaining keyword arguments are passed.
+    The resident memory therefore stays bounded irrespective of the size of
+    the files. Returns the memory mapped result.
+    """
+    if not isinstance(colormap, core.BaseColormap):
+        colormap = managers.get(colormap)
+
+    values = open_source(src, dtype=dtype, shape=shape)
+    if no_data_value is None:
+        data = values
+    else:
+        data = {'values': values, 'no_data_value': no_data_value}
+
+    if packed:
+        target = open_target(dst, dtype='u4', shape=values.shape)
+    else:
+        target = open_target(dst, dtype='u1', shape=values.shape + (4,))
+
+    colormap.render_chunked(
+        data, limits=limits, out=target, packed=packed, **kwargs
+    )
+    target.flush()
+    return target
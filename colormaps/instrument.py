@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+"""
+Opt-in instrumentation of the rendering and loading stages.
+
+Stages of rendering (mask, index, gather, lookup tables) and of loading by
+a Manager (load, build) report a record per call to the subscribed
+callbacks. A record is a plain dict with at least the name of the stage and
+its wall time in seconds, plus stage specific fields like the number of
+pixels, the number of masked pixels and the number of bytes produced. When
+tracemalloc is tracing, the bytes allocated during the stage are included.
+
+Without subscribers, the rendering path only checks the enabled flag, and
+the stages of infrequent work like loading cost a function call returning a
+shared no-op context manager, so the instrumentation can stay in place::
+
+    >>> with instrument.recording() as records:
+    ...     colormap(data)
+    >>> instrument.summarize(records)
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+import tracemalloc
+
+enabled = False
+callbacks = []
+lock = threading.Lock()
+
+
+class Null(object):
+    """ Stage that records nothing, used when instrumentation is disabled. """
+    def __bool__(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def update(self, **fields):
+        pass
+
+
+NULL = Null()
+
+
+class Stage(object):
+    """ Times a stage and reports its record to the callbacks on exit. """
+    def __init__(self, name, fields):
+        self.record = {'stage': name}
+        self.record.update(fields)
+
+    def __enter__(self):
+        self.memory = None
+        if tracemalloc.is_tracing():
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.record['seconds'] = time.perf_counter() - self.start
+        if self.memory is not None and tracemalloc.is_tracing():
+            allocated = tracemalloc.get_traced_memory()[0] - self.memory
+            self.record['allocated'] = allocated
+        for callback in list(callbacks):
+            callback(self.record)
+
+    def update(self, **fields):
+        """ Add fields to the record. """
+        self.record.update(fields)
+
+
+def stage(name, **fields):
+    """
+    Return context manager for a stage.
+
+    The returned object is false when instrumentation is disabled, so that
+    costly fields can be computed only when needed::
+
+        with instrument.stage('mask') as stage:
+            ...
+            if stage:
+                stage.update(masked=np.count_nonzero(mask))
+    """
+    if not enabled:
+        return NULL
+    return Stage(name, fields)
+
+
+def subscribe(callback):
+    """ Call callback with the record of every stage from now on. """
+    global enabled
+    with lock:
+        callbacks.append(callback)
+        enabled = True
+
+
+def unsubscribe(callback):
+    """ Stop calling callback, disabling instrumentation after the last. """
+    global enabled
+    with lock:
+        callbacks.remove(callback)
+        enabled = bool(callbacks)
+
+
+@contextmanager
+def recording():
+    """ Return list that collects the records of the stages in the block. """
+    records = []
+    subscribe(records.append)
+    try:
+        yield records
+    finally:
+        unsubscribe(records.append)
+
+
+def summarize(records):
+    """
+    Return dict of totals per stage.
+
+    Totals are the count, the seconds and, if present in the records, the
+    pixels, masked pixels, bytes and allocated bytes.
+    """
+    summary = {}
+    for record in records:
+        totals = summary.setdefault(record['stage'], {'count': 0})
+        totals['count'] += 1
+        for field in 'seconds', 'pixels', 'masked', 'nbytes', 'allocated':
+            if field in record:
+                totals[field] = totals.get(field, 0) + record[field]
+    return summary
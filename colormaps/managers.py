@@ -1,15 +1,33 @@
 # -*- coding: utf-8 -*-
 # (c) Nelen & Schuurmans, see LICENSE.rst.
 
+import asyncio
 import json
 import os
+import tempfile
+import threading
+import weakref
 
+from colormaps import bundles
+from colormaps import cache
 from colormaps import core
+from colormaps import instrument
 
 BASE_PATH = os.path.dirname(__file__)
 DATA_PATH = os.path.abspath(os.path.join(BASE_PATH, 'data'))
 LABELS_PATH = os.path.abspath(os.path.join(BASE_PATH, 'labels'))
 
+INDEX_VERSION = 1
+
+CACHE_SIZE = 256
+CACHE_BYTES = 2 ** 26
+
+default = None
+default_lock = threading.Lock()
+
+# the colormap last loaded by any manager per name, as long as it is in use
+loaded = weakref.WeakValueDictionary()
+
 
 class Manager(object):
     """ Loads colormaps from a path. """
@@ -27,40 +45,343 @@ class Manager(object):
             return dict(json.load(json_file))
 
     def get_labels(self, name):
-        """ Return locale dict of label dicts. """
+        """ Return labels by locale, each loaded when first used. """
         base = os.path.join(LABELS_PATH, name)
         if not os.path.exists(base):
             return {}
-        names = os.listdir(base)
-        paths = [os.path.join(base, n) for n in names]
-        locales = [os.path.splitext(n)[0] for n in names]
-        return {l: self.load_label(p) for l, p in zip(locales, paths)}
+        return core.Labels({
+            os.path.splitext(n)[0]: os.path.join(base, n)
+            for n in os.listdir(base)
+        })
+
+    def scan(self, index, relpath=''):
+        """
+        Return list of relative file paths below relpath.
+
+        :param index: dict of directory listings by relative path
+
+        Directories are only listed if their modification time differs from
+        the one in the index. As adding, removing or renaming an entry
+        changes the modification time of its directory, only the changed
+        parts of the tree are listed again. The listings of the directories
+        that were visited end up in self.index.
+        """
+        path = os.path.join(self.path, relpath)
+        mtime = os.stat(path).st_mtime_ns
+        entry = index.get(relpath)
+        if entry is None or entry['mtime'] != mtime:
+            files, dirs = [], []
+            # as os.walk, symlinked directories are not followed
+            for item in os.scandir(path):
+                if item.is_dir(follow_symlinks=False):
+                    dirs.append(item.name)
+                elif not item.is_dir():
+                    files.append(item.name)
+            entry = {'mtime': mtime, 'files': files, 'dirs': dirs}
+        self.index[relpath] = entry
+
+        inventory = [os.path.join(relpath, f) for f in entry['files']]
+        for name in entry['dirs']:
+            inventory.extend(self.scan(index, os.path.join(relpath, name)))
+        return inventory
+
+    def load_index(self):
+        """ Return directory listings from the index file, if valid. """
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+        except (IOError, ValueError):
+            return {}
+        if index.get('version') != INDEX_VERSION:
+            return {}
+        if index.get('path') != self.path:
+            return {}
+        return index['dirs']
+
+    def save_index(self, index):
+        """
+        Write directory listings to the index file.
+
+        The file is replaced atomically by a uniquely named temporary file,
+        so that concurrent writers do not interfere. Failing to write is not
+        an error, the index only speeds up later initializations.
+        """
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=directory,
+                                                 suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, 'w') as index_file:
+                json.dump({'version': INDEX_VERSION,
+                           'path': self.path,
+                           'dirs': index}, index_file)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def __init__(self, path=DATA_PATH, index_path=None, bundle_path=None,
+                 cache_size=CACHE_SIZE, cache_bytes=CACHE_BYTES):
+        """
+        :param path: path to the colormap collection
+        :param index_path: path to a file to persist the inventory in
+        :param bundle_path: path to a bundle to load colormaps from
+        :param cache_size: maximum number of loaded colormaps to keep
+        :param cache_bytes: maximum size of the arrays of loaded colormaps,
+            including the tables cached by the colormaps themselves
 
-    def __init__(self, path=DATA_PATH):
-        self.path = path
+        With an index_path, the inventory of the collection is stored and
+        on later initializations only the changed directories are listed.
+        The index_path must be outside of the collection, since writing it
+        would otherwise change the collection.
 
-        # read data
-        self.inventory = []
-        for basedir, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                self.inventory.append(os.path.join(basedir, filename))
+        With a bundle_path, colormaps are loaded from a bundle built from
+        the collection by Manager.compile() instead, and the
+        collection itself is not accessed at all.
+        """
+        self.path = os.path.abspath(path)
+        self.cache = cache.LRU(
+            size=cache_size, nbytes=cache_bytes, weigh=lambda c: c.nbytes,
+        )
+        self.futures = {}
+        self.bundle = None
+        if bundle_path is not None:
+            self.bundle = bundles.Bundle(bundle_path)
+            self.registered = dict.fromkeys(self.bundle.names, bundle_path)
+            self._keys = self.bundle.keys
+            return
+
+        self.index_path = index_path
+        if index_path is not None:
+            relpath = os.path.relpath(os.path.abspath(index_path), self.path)
+            if not relpath.startswith(os.pardir):
+                raise ValueError('The index_path must be outside the path.')
+
+        self.lock = threading.Lock()
+        self.stamps = {}
+        self.build({} if index_path is None else self.load_index())
+
+    def build(self, index):
+        """ Scan the collection, reusing listings in index, and register. """
+        self.index = {}
+        inventory = [os.path.join(self.path, p) for p in self.scan(index)]
+        if self.index_path is not None and self.index != index:
+            self.save_index(self.index)
 
         # build dict
-        self.registered = {self.get_id(p): p for p in self.inventory}
+        self.inventory = inventory
+        self.registered = {self.get_id(p): p for p in inventory}
+        self._keys = sorted([(self.get_key(p),
+                              self.get_id(p)) for p in inventory])
 
     @property
     def keys(self):
-        return sorted([(self.get_key(p),
-                        self.get_id(p)) for p in self.inventory])
+        return list(self._keys)
+
+    def stamp(self, name):
+        """ Return modification times and sizes of the files of a colormap. """
+        paths = [self.registered[name]]
+        base = os.path.join(LABELS_PATH, name)
+        if os.path.exists(base):
+            paths.extend(os.path.join(base, n) for n in os.listdir(base))
+        stamp = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stamp.append((path, None, None))
+            else:
+                stamp.append((path, stat.st_mtime_ns, stat.st_size))
+        return sorted(stamp)
+
+    def load(self, name):
+        """ Return new colormap from the collection or from the bundle. """
+        if self.bundle is not None:
+            with instrument.stage('load', colormap=name, source='bundle'):
+                colormap = self.bundle.get(name)
+            loaded[name] = colormap
+            return colormap
+        with instrument.stage('load', colormap=name, source='json'):
+            stamp = self.stamp(name)  # before reading, so none is missed
+            with open(self.registered[name]) as f:
+                config = json.load(f)
+            config['labels'] = self.get_labels(name)
+            with instrument.stage('build', colormap=name) as stage:
+                colormap = core.create(config)
+                if stage:
+                    stage.update(nbytes=colormap.nbytes)
+        self.stamps[name] = stamp
+        loaded[name] = colormap
+        return colormap
+
+    def refresh(self):
+        """
+        Pick up changes in the collection and return the changed names.
+
+        Only directories that changed are listed again, and only the files
+        of the cached colormaps are checked for modifications, by their
+        modification time and size. Modified colormaps are rebuilt and then
+        replace the cached ones, other cached colormaps are left alone.
+        Colormaps that fail to load are dropped from the cache, so that the
+        error shows up when they are requested.
+        """
+        if self.bundle is not None:
+            raise ValueError('A manager for a bundle cannot be refreshed.')
+        with self.lock:
+            registered = self.registered
+            self.build(self.index)
+            changed = {n for n in set(registered) | set(self.registered)
+                       if registered.get(n) != self.registered.get(n)}
+
+            for name in self.cache.keys():
+                if name not in changed:
+                    if self.stamps.get(name) == self.stamp(name):
+                        continue
+                    changed.add(name)
+                if name not in self.registered:
+                    self.cache.discard(name)
+                    continue
+                # the cached colormap is served until its replacement is
+                # built, put replaces it in one step
+                try:
+                    colormap = self.load(name)
+                except (IOError, ValueError, KeyError, TypeError):
+                    self.cache.discard(name)
+                    continue
+                self.cache.put(name, colormap)
+
+            for name in set(self.stamps) - set(self.cache.keys()):
+                self.stamps.pop(name, None)
+        return sorted(changed)
+
+    def watch(self, interval=5.0, callback=None):
+        """
+        Return started watcher that refreshes this manager periodically.
+
+        :param interval: seconds between refreshes
+        :param callback: called with the list of changed names, if any
+        """
+        watcher = Watcher(self, interval=interval, callback=callback)
+        watcher.start()
+        return watcher
+
+    def compile(self, path):
+        """
+        Build a bundle of all colormaps in the collection.
+
+        :param path: path of the .npy file to write
+
+        Use the bundle with Manager(bundle_path=path).
+        """
+        colormaps = {name: self.load(name) for name in self.registered}
+        bundles.build(path, colormaps=colormaps, keys=self._keys)
 
     def get(self, name):
+        """
+        Return colormap by name.
+
+        Colormaps registered with register() take precedence. Others are
+        loaded from the collection and kept in the cache of this manager,
+        so that managers for different collections do not interfere.
+        """
         if name in core.registered:
             return core.registered[name]
         if name in self.registered:
-            with open(self.registered[name]) as f:
-                config = json.load(f)
-            config['labels'] = self.get_labels(name)
-            colormap = core.create(config)
-            colormap.register(name)
-            return colormap
+            return self.cache.get(name, lambda: self.load(name))
         raise NameError("'{}' is not in registered colormaps".format(name))
+
+    async def aget(self, name, executor=None):
+        """
+        Return colormap by name, loading it in an executor if needed.
+
+        :param executor: executor to load in, default the loop's default
+
+        Concurrent calls for the same name share a single load. Cancelling
+        a call does not cancel the load for the other callers.
+        """
+        if name in core.registered:
+            return core.registered[name]
+        if name in self.cache:
+            return self.get(name)
+        loop = asyncio.get_running_loop()
+        future = self.futures.get(name)
+        if future is None or future.get_loop() is not loop:
+            future = loop.run_in_executor(executor, self.get, name)
+            self.futures[name] = future
+
+            def done(future):
+                if self.futures.get(name) is future:
+                    del self.futures[name]
+
+            future.add_done_callback(done)
+        return await asyncio.shield(future)
+
+    async def preload(self, names=None, concurrency=4, executor=None):
+        """
+        Load colormaps into the cache in the background.
+
+        :param names: names to load, default all names in the collection
+        :param concurrency: maximum number of simultaneous loads
+        :param executor: executor to load in, default the loop's default
+
+        Preloading more colormaps than the cache can hold only leaves the
+        most recently loaded ones in the cache.
+        """
+        if names is None:
+            names = sorted(self.registered)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def load(name):
+            async with semaphore:
+                await self.aget(name, executor=executor)
+
+        await asyncio.gather(*(load(name) for name in names))
+
+
+class Watcher(threading.Thread):
+    """ Refreshes a manager periodically until stopped. """
+    def __init__(self, manager, interval=5.0, callback=None):
+        super(Watcher, self).__init__(daemon=True)
+        self.manager = manager
+        self.interval = interval
+        self.callback = callback
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            changed = self.manager.refresh()
+            if changed and self.callback is not None:
+                self.callback(changed)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def get_default():
+    """ Return manager for the builtin collection, created on first use. """
+    global default
+    with default_lock:
+        if default is None:
+            default = Manager()
+    return default
+
+
+def get(name):
+    """
+    Return colormap by name.
+
+    Registered colormaps come first, then colormaps loaded by any manager
+    that are still in use, as managers used to register the colormaps they
+    loaded. Other names are taken from the builtin collection.
+    """
+    if name in core.registered:
+        return core.registered[name]
+    colormap = loaded.get(name)
+    if colormap is not None:
+        return colormap
+    return get_default().get(name)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans, see LICENSE.rst.
+
+import numpy as np
+
+from colormaps import core
+
+
+class Statistics(object):
+    """
+    Mergeable statistics of data that is fed block by block.
+
+    Keeps the count, minimum and maximum of the valid values, and a
+    histogram with a fixed number of bins for approximate percentiles. The
+    histogram range is adapted to the data by doubling the bin width as
+    needed, so no range has to be known in advance.
+
+    Statistics can be passed as limits to colormaps, which then use the
+    limits determined by the stretch percentiles. The default stretch uses
+    the exact minimum and maximum, as a free gradient would.
+    """
+    def __repr__(self):
+        template = '<{name}: count {count}, min {min}, max {max}>'
+        return template.format(count=self.count,
+                               min=self.min,
+                               max=self.max,
+                               name=self.__class__.__name__)
+
+    def __init__(self, bins=1024, stretch=(0, 100)):
+        """
+        :param bins: number of histogram bins, even, or 0 for no histogram
+        :param stretch: lower, upper percentiles to use as limits
+        """
+        if bins % 2:
+            raise ValueError('The number of bins should be even.')
+        self.bins = bins
+        self.stretch = stretch
+        self.count = 0
+        self.min = None
+        self.max = None
+
+        # histogram, without range until there are two distinct values
+        self.lower = None
+        self.width = None
+        self.histogram = np.zeros(bins, dtype='i8')
+
+    def extend(self, lower, upper):
+        """ Extend the histogram range to include lower and upper. """
+        if self.width is None:
+            # without histogram, all values so far are equal to the minimum
+            value = lower if self.min is None else self.min
+            start, stop = min(lower, value), max(upper, value)
+            if start == stop:
+                return
+            # slightly wider, so that rounding does not exclude the stop
+            self.lower = float(start)
+            self.width = (float(stop) - self.lower) / self.bins * (1 + 1e-12)
+            if self.count:
+                self.add(value, self.count)
+            return
+
+        half = self.bins // 2
+        while (lower < self.lower or
+               upper > self.lower + self.bins * self.width):
+            merged = self.histogram.reshape(-1, 2).sum(axis=1)
+            self.histogram[:] = 0
+            if lower < self.lower:
+                self.histogram[half:] = merged
+                self.lower -= self.bins * self.width
+            else:
+                self.histogram[:half] = merged
+            self.width *= 2
+
+    def locate(self, values):
+        """ Return bin indices for values. """
+        index = np.array(values, dtype='f8')
+        index -= self.lower
+        index /= self.width
+        np.floor(index, out=index)
+        np.clip(index, 0, self.bins - 1, out=index)
+        return index.astype(np.intp)
+
+    def add(self, values, weights):
+        """ Add weights of values to the histogram. """
+        np.add.at(self.histogram, self.locate(values), weights)
+
+    def update(self, data, mask=None):
+        """
+        Add the valid values of data.
+
+        :param data: dict, masked array or anything numpy can make an array of
+        :param mask: optional boolean array, True where values are masked
+
+        Besides the given mask, the no data value or the mask of the data and
+        non-finite values are masked.
+        """
+        values, data_mask = core.split(data)
+        if values.dtype.kind not in 'biu':
+            nan_mask = ~np.isfinite(values)
+            data_mask = nan_mask if data_mask is None else data_mask | nan_mask
+        if data_mask is not None:
+            mask = data_mask if mask is None else mask | data_mask
+        if not np.any(mask):
+            mask = None
+
+        extremes = core.extremes(values, mask)
+        if extremes is None:
+            return
+        lower, upper = extremes
+
+        if self.bins:
+            self.extend(lower, upper)
+        self.min = lower if self.min is None else min(self.min, lower)
+        self.max = upper if self.max is None else max(self.max, upper)
+        self.count += values.size if mask is None else values.size - mask.sum()
+        if self.width is None:
+            return
+
+        with np.errstate(invalid='ignore'):  # masked values may be nan
+            index = self.locate(values)
+        if mask is not None:
+            index[mask] = self.bins  # counted in an extra bin, dropped below
+        counts = np.bincount(index.ravel(), minlength=self.bins + 1)
+        self.histogram += counts[:self.bins]
+
+    def merge(self, other):
+        """ Add the values of other statistics. """
+        if not other.count:
+            return
+        if self.bins and other.width is None:
+            self.extend(other.min, other.max)
+        elif self.bins:
+            upper = other.lower + other.bins * other.width
+            self.extend(min(other.lower, other.min), max(upper, other.max))
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.count += other.count
+        if self.width is None:
+            return
+        if other.width is None:
+            self.add(other.min, other.count)
+        else:
+            # approximate, by assigning the other bins by their centers
+            centers = other.lower + other.width * (np.arange(other.bins) + 0.5)
+            self.add(centers, other.histogram)
+
+    def percentile(self, q):
+        """ Return approximate q-th percentile, exact for 0 and 100. """
+        if not self.count:
+            return None
+        if q <= 0 or self.min == self.max:
+            return self.min
+        if q >= 100:
+            return self.max
+        if self.width is None:
+            raise ValueError('Percentiles need a histogram.')
+        cumulative = np.cumsum(self.histogram)
+        target = q / 100 * self.count
+        index = int(np.searchsorted(cumulative, target))
+        previous = cumulative[index - 1] if index else 0
+        fraction = (target - previous) / self.histogram[index]
+        value = self.lower + (index + fraction) * self.width
+        return min(max(value, self.min), self.max)
+
+    def get_limits(self):
+        """ Return limits according to the stretch, or None if no data. """
+        if not self.count:
+            return None
+        lower, upper = self.stretch
+        return np.array([self.percentile(lower), self.percentile(upper)])
@@ -2,15 +2,23 @@
 # (c) Nelen & Schuurmans, see LICENSE.rst.
 
 from math import exp
+import asyncio
+import json
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 import numpy as np
 
 import colormaps
+from colormaps import benchmarks
+from colormaps import blend
+from colormaps import cache
 from colormaps import core
+from colormaps import instrument
 from colormaps import utils
 
 MASKED = [0, 0, 255, 255]
@@ -32,9 +40,11 @@ def discrete():
 
 
 def gradient(size=3, log=False, free=True, interp=None,
-             data_values=(3, 5)):
+             data_values=(3, 5), precision='float64', bake=False):
     colormap = {
         'type': 'GradientColormap',
+        'precision': precision,
+        'bake': bake,
         'size': size,
         'free': free,
         'log': log,
@@ -172,6 +182,92 @@ class TestColormap(unittest.TestCase):
              [000, 000, 255, 255]],
         )
 
+    def test_gradient_normalize(self):
+        # the fused kernel must match the chained Data transforms exactly
+        data = np.random.RandomState(0).uniform(1, 9, 100)
+        interp = [(1, 1), (4, 8), (9, 9)]
+        for dtype, log, limits in (('f8', False, None),
+                                   ('f4', True, (2, 8)),
+                                   ('i2', False, (8, 2))):
+            colormap = gradient(size=256, log=log, interp=interp)
+            expected = core.Data(data=data.astype(dtype), limits=limits)
+            expected = expected.interp(colormap.interp)
+            if log:
+                expected = expected.log()
+            expected = expected.scale().data.clip(0, 1)
+            self.assertEqual(
+                colormap.normalize(data.astype(dtype), limits).tolist(),
+                expected.tolist(),
+            )
+
+    def test_gradient_float32(self):
+        state = np.random.RandomState(0)
+        data = state.uniform(1, 9, 100000)
+        for log, interp, limits in ((False, None, None),
+                                    (True, None, (2, 8)),
+                                    (True, [(1, 1), (4, 8), (9, 9)], None),
+                                    (False, [(1, 9), (9, 1)], (8, 2))):
+            double = gradient(size=256, log=log, interp=interp)
+            single = gradient(size=256, log=log, interp=interp,
+                              precision='float32')
+            self.assertEqual(single.rgba.tolist(), double.rgba.tolist())
+            self.assertEqual(single.normalize(data, limits).dtype, 'f4')
+            difference = (single.index(data, limits) -
+                          double.index(data, limits))
+            self.assertLessEqual(np.abs(difference).max(), 1)
+        self.assertRaises(ValueError, gradient, precision='float16')
+
+    def test_gradient_baked(self):
+        data = np.random.RandomState(0).uniform(0, 10, core.BAKE_SIZE)
+        data[0] = np.nan
+        mask = np.isnan(data)
+        interp = [(1, 1), (4, 8), (9, 9)]
+        for log, limits in (True, (2, 8)), (False, (9, 0)):
+            colormap = gradient(size=256, log=log, interp=interp, bake=True)
+            exact = gradient(size=256, log=log, interp=interp)
+            difference = (colormap.index(data, limits, mask=mask) -
+                          exact.index(data, limits, mask=mask))
+            self.assertLessEqual(np.abs(difference).max(), 1)
+            baked = colormap.get_baked(limits)
+            self.assertLessEqual(baked.error, 1)
+            self.assertTrue(repr(baked))
+            # the limits themselves are exact
+            self.assertEqual(baked(limits).tolist(),
+                             exact.index(np.array(limits), limits).tolist())
+            # cached
+            self.assertIs(colormap.get_baked(limits), baked)
+
+    def test_gradient_baked_log(self):
+        # many decades, sampled in log space
+        data = 10 ** np.random.RandomState(0).uniform(-4, 5, 10000)
+        limits = 1e-3, 1e4
+        colormap = gradient(size=256, log=True, bake=True)
+        exact = gradient(size=256, log=True)
+        difference = colormap.index(data, limits) - exact.index(data, limits)
+        self.assertLessEqual(np.abs(difference).max(), 1)
+        self.assertLessEqual(colormap.get_baked(limits).error, 1)
+
+    def test_gradient_baked_fallback(self):
+        # a step too steep to sample uses the exact path
+        interp = [(0, 0), (1, 0), (1 + 1e-9, 1), (1e6, 1)]
+        data = np.array([0.5, 1 + 1e-9, 2])
+        colormap = gradient(size=256, interp=interp, bake=True)
+        exact = gradient(size=256, interp=interp)
+        limits = 0, 1e6
+        self.assertIsNone(colormap.get_baked(limits).table)
+        self.assertEqual(colormap.index(data, limits).tolist(),
+                         exact.index(data, limits).tolist())
+
+    def test_gradient_chunked_identical(self):
+        data = 10 ** np.random.RandomState(0).uniform(-1, 2, (40, 40))
+        for bake in False, True:
+            colormap = gradient(size=256, log=True, free=False, bake=bake,
+                                data_values=(0.1, 100))
+            self.assertEqual(
+                colormap.render_chunked(data, chunk_size=5).tolist(),
+                colormap(data).tolist(),
+            )
+
     def test_gradient_legend_data_limits_doesnt_clip(self):
         colormap = gradient()
         # Should map the data to the 0...2 range, even if the limits of
@@ -270,6 +366,31 @@ class TestColormap(unittest.TestCase):
         self.assertEqual(colormap.label(0), 'label0')
         self.assertEqual(colormap.label([0, 1, 2]), ['label0', 1, 'label2'])
 
+    def test_label_vectorized(self):
+        labels = {'en_EN': {3: 'three', -1: 'minus one', 10 ** 9: 'big'},
+                  'nl_NL': {3: 'drie'}}
+        colormap = discrete()
+        colormap.labels = core.Labels(labels)
+        self.assertEqual(
+            colormap.label(np.array([[-1, 3], [4, 10 ** 9]])),
+            [['minus one', 'three'], [4, 'big']],
+        )
+        self.assertEqual(colormap.label([3.0, 3.5]), ['three', 3.5])
+        self.assertEqual(colormap.label(3, locale='nl_NL'), 'drie')
+        self.assertEqual(colormap.label(3, locale='xx_XX'), 'three')
+
+        # dense table, also for values outside of it
+        colormap.labels = core.Labels({'en_EN': {0: 'zero', 2: 'two'}})
+        self.assertIsNotNone(colormap.labels.get_table('en_EN')[2])
+        self.assertEqual(
+            colormap.label(np.array([-1, 0, 1, 2, 3], dtype='i1')),
+            [-1, 'zero', 1, 'two', 3],
+        )
+
+        # non-numeric keys
+        colormap.labels = core.Labels({'en_EN': {'a': 'A'}})
+        self.assertEqual(colormap.label(['a', 'b']), ['A', 'b'])
+
     def test_discrete(self):
         colormap = discrete()
         # scalar
@@ -298,6 +419,280 @@ class TestColormap(unittest.TestCase):
         expected = MASKED, [127, 0, 0, 255], INVALID, MASKED, MASKED
         assert expected == result
 
+    def test_out(self):
+        for colormap in gradient(), discrete():
+            data = np.ma.masked_equal([[0, 2], [3, 4]], 3)
+            out = np.empty((2, 2, 4), 'u1')
+            self.assertIs(colormap(data, out=out), out)
+            self.assertEqual(out.tolist(), colormap(data).tolist())
+            self.assertIs(colormap(data.data, out=out), out)
+            self.assertEqual(out.tolist(), colormap(data.data).tolist())
+            self.assertRaises(ValueError, colormap, data, out=out[0])
+
+    def test_packed(self):
+        for colormap in gradient(), discrete():
+            data = np.ma.masked_equal([[0, 2], [3, 4]], 3)
+            packed = colormap(data, packed=True)
+            self.assertEqual(packed.dtype, np.dtype('u4'))
+            self.assertEqual(
+                packed.view('u1').reshape(2, 2, 4).tolist(),
+                colormap(data).tolist(),
+            )
+            out = np.empty((2, 2), 'u4')
+            self.assertIs(colormap(data.data, out=out, packed=True), out)
+            self.assertEqual(
+                out.view('u1').reshape(2, 2, 4).tolist(),
+                colormap(data.data).tolist(),
+            )
+
+    def test_render_chunked(self):
+        values = np.random.RandomState(0).uniform(-1, 6, (7, 5))
+        values[1] = 3  # a row that is all no data
+        for colormap in gradient(), gradient(log=True), discrete():
+            for data in (values,
+                         values.astype('f4'),
+                         dict(values=values, no_data_value=3),
+                         np.ma.masked_less(values, 2)):
+                expected = colormap(data).tolist()
+                self.assertEqual(
+                    colormap.render_chunked(data, chunk_size=2).tolist(),
+                    expected,
+                )
+                self.assertEqual(
+                    colormap.render_chunked(data, max_bytes=1).tolist(),
+                    expected,
+                )
+                self.assertEqual(
+                    colormap.render_chunked(data, workers=3).tolist(),
+                    expected,
+                )
+        out = np.empty((7, 5), 'u4')
+        result = colormap.render_chunked(values, out=out, packed=True)
+        self.assertIs(result, out)
+        self.assertEqual(colormap.render_chunked(7).tolist(), MASKED)
+
+    def test_lookup(self):
+        state = np.random.RandomState(0)
+        for dtype in 'u1', 'i1', 'u2', 'i2':
+            values = state.randint(-300, 300, (9, 9)).astype(dtype)
+            for colormap in (gradient(),
+                             gradient(free=False),
+                             gradient(log=True, interp=[(1, 1), (9, 9)]),
+                             discrete(),
+                             colormaps.DiscreteColormap([(-9, INVALID),
+                                                         (10 ** 6, MASKED)])):
+                for data, limits in ((values, None),
+                                     (values, (-5, 250)),
+                                     (dict(values=values,
+                                           no_data_value=values[0, 0]), None),
+                                     (np.ma.masked_less(values, 10), None)):
+                    self.assertEqual(
+                        colormap.lookup(data, limits).tolist(),
+                        colormap.render(data, limits).tolist(),
+                    )
+                    self.assertEqual(
+                        colormap.lookup(data, limits, packed=True).tolist(),
+                        colormap.render(data, limits, packed=True).tolist(),
+                    )
+                    index = colormap.lookup(data, limits, indices=True)
+                    self.assertEqual(
+                        colormap.get_palette()[index].tolist(),
+                        colormap.render(data, limits).tolist(),
+                    )
+            self.assertEqual(
+                colormap.lookup(values, packed=True).tolist(),
+                colormap.render(values, packed=True).tolist(),
+            )
+        # large enough arrays use the lookup by default, with cached tables
+        colormap = gradient(free=False)
+        values = np.arange(256, dtype='u1')
+        self.assertEqual(colormap(values).tolist(),
+                         colormap.render(values).tolist())
+        colormap(values)
+        self.assertEqual(colormap.cache.hits, 1)
+        # but not when the limits depend on the data
+        colormap = gradient()
+        colormap(values)
+        colormap(values // 2)
+        self.assertEqual(colormap.cache.keys(), [])
+
+    def test_discrete_sparse(self):
+        for codes in (-2, 0, 2), (0, 2, 10 ** 6), (-10 ** 6, 0, 2):
+            colormap = colormaps.DiscreteColormap(
+                data=[(codes[0], (1, 0, 0, 255)),
+                      (codes[1], (127, 0, 0, 255)),
+                      (codes[2], (255, 0, 0, 255))],
+                masked=MASKED,
+                invalid=INVALID,
+            )
+            self.assertEqual(colormap.codes is None, codes[0] == -2)
+            self.assertLess(len(colormap), 10 ** 5)
+            data = dict(values=[codes[0], codes[1], 1, codes[2], 3 ** 20, 5],
+                        no_data_value=5)
+            self.assertEqual(
+                colormap(data).tolist(),
+                [[1, 0, 0, 255],
+                 [127, 0, 0, 255],
+                 INVALID,
+                 [255, 0, 0, 255],
+                 MASKED,
+                 MASKED],
+            )
+            self.assertEqual(colormap(codes[2]).tolist(), [255, 0, 0, 255])
+            self.assertEqual(colormap(1).tolist(), INVALID)
+            self.assertEqual(
+                colormap(codes[0], limits=codes[1:]).tolist(), MASKED,
+            )
+            self.assertEqual(colormap.get_legend_data(None, None).tolist(),
+                             list(codes))
+            self.assertEqual(colormap.get_legend_data((0, 2), None).tolist(),
+                             [c for c in codes if 0 <= c <= 2])
+
+    def test_index_masked(self):
+        for colormap in gradient(), discrete():
+            self.assertEqual(colormap.lut[-1].tolist(), MASKED)
+            data = np.array([2, np.nan, 0])
+            mask = np.isnan(data)
+            index = colormap.index(data, None, mask=mask)
+            self.assertEqual(index[1], len(colormap.lut) - 1)
+            self.assertEqual(
+                colormap.gather(index).tolist(),
+                colormap(data).tolist(),
+            )
+
+    def test_indices(self):
+        data = np.ma.masked_array([[0, 1], [2, 7]], [[0, 0, ], [1, 0]])
+        for colormap in gradient(), gradient(size=256), discrete():
+            rgba = colormap(data)
+            index, palette = colormap(data, indices=True)
+            self.assertEqual(palette[index].tolist(), rgba.tolist())
+            self.assertEqual(index[1, 0], len(palette) - 1)
+            dtype = 'u1' if len(palette) <= 256 else 'u2'
+            self.assertEqual(index.dtype, dtype)
+
+            # domain lookup
+            values = np.arange(256, dtype='u1')
+            rgba = colormap(values, limits=(0, 2))
+            index, palette = colormap(values, limits=(0, 2), indices=True)
+            self.assertEqual(palette[index].tolist(), rgba.tolist())
+
+        out = np.empty((2, 2), 'u2')
+        index, palette = gradient(size=256)(data, out=out, indices=True)
+        self.assertIs(index, out)
+        self.assertEqual(len(palette), 257)
+        self.assertRaises(
+            ValueError, gradient(), data, packed=True, indices=True,
+        )
+
+    def test_indices_builtin(self):
+        # a gradient of size 256 without masked elements
+        colormap = colormaps.get('jet')
+        data = np.linspace(0, 1, 1000)
+        index, palette = colormap(data, indices=True)
+        self.assertEqual((index.dtype, len(palette)), ('u1', 256))
+        self.assertEqual(palette[index].tolist(), colormap(data).tolist())
+        index, palette = colormap(np.ma.masked_less(data, 0.5), indices=True)
+        self.assertEqual((index.dtype, len(palette)), ('u2', 257))
+
+        # an out array must hold the masked index
+        data[0] = np.nan
+        out = np.empty(data.shape, 'u1')
+        self.assertRaises(ValueError, colormap, data, out=out, indices=True)
+        values = np.ma.masked_equal(np.arange(2 ** 16, dtype='u2'), 0)
+        self.assertRaises(ValueError, colormap, values, limits=(0, 9),
+                          out=np.empty(values.shape, 'u1'), indices=True)
+        out = np.empty(values.shape, 'u2')
+        index, palette = colormap(values, limits=(0, 9), out=out,
+                                  indices=True)
+        self.assertIs(index, out)
+        self.assertEqual(index[0], 256)
+        self.assertEqual(palette[index].tolist(),
+                         colormap(values, limits=(0, 9)).tolist())
+
+        # a compact palette for a discrete colormap with a dense table
+        colormap = colormaps.get('lc-phy')
+        data = np.ma.masked_equal(np.arange(-5, 1100) % 1003, 7)
+        index, palette = colormap(data, indices=True)
+        colors = np.unique(colormap.rgba[:-1].view('u4'))
+        self.assertEqual((index.dtype, len(palette)), ('u1', len(colors) + 1))
+        self.assertLessEqual(len(palette), 256)
+        self.assertEqual(palette[index].tolist(), colormap(data).tolist())
+        self.assertEqual(index[12], len(palette) - 1)
+
+    def test_overview(self):
+        values = np.ma.masked_array(
+            [[1, 3, 5, 5, 9],
+             [0, 0, 5, 5, 9],
+             [2, 2, 2, 0, 9]],
+            mask=[[0, 0, 0, 0, 0],
+                  [1, 1, 0, 0, 0],
+                  [1, 1, 0, 1, 1]],
+        )
+        colormap = gradient(size=256)
+        limits = 1, 9
+        expected = np.ma.masked_array(
+            [[2, 5, 9], [0, 2, 0]], mask=[[0, 0, 0], [1, 0, 1]],
+        )
+        self.assertEqual(
+            colormap.overview(values).tolist(),
+            colormap(expected, limits=limits).tolist(),
+        )
+        expected[0, 0] = 3
+        self.assertEqual(
+            colormap.overview(values, method='max').tolist(),
+            colormap(expected, limits=limits).tolist(),
+        )
+        level1, level2 = colormap.pyramid(values, levels=2, method='min')
+        self.assertEqual(
+            level2.tolist(), colormap([[1, 9]], limits=limits).tolist(),
+        )
+        self.assertRaises(ValueError, colormap.overview, values, method='x')
+        self.assertRaises(ValueError, colormap.overview, np.arange(3))
+
+        colormap = discrete()
+        values = [[0, 0, 2, 1], [2, 1, 1, 1]]
+        self.assertEqual(
+            colormap.overview(values).tolist(),
+            colormap([[0, 1]]).tolist(),
+        )
+        self.assertEqual(
+            colormap.overview(values, factor=4, packed=True).tolist(),
+            colormap([[1]], packed=True).tolist(),
+        )
+
+    def test_frames(self):
+        colormap = gradient(size=256)
+        stack = np.ma.masked_array(
+            np.arange(24, dtype='f8').reshape(4, 2, 3),
+            mask=np.arange(24).reshape(4, 2, 3) % 5 == 0,
+        )
+        frames = [stack[i] for i in range(4)]
+        shared = colormap(stack)
+        separate = np.array([colormap(frame) for frame in frames])
+        self.assertFalse(np.equal(shared, separate).all())
+
+        # shared limits, for a stack and for an iterable
+        self.assertTrue(np.equal(colormap.render_frames(stack), shared).all())
+        rgba = colormap.render_frames(iter(frames))
+        self.assertTrue(np.equal(rgba, shared).all())
+        rgba = np.array(list(colormap.iter_frames(iter(frames))))
+        self.assertTrue(np.equal(rgba, shared).all())
+
+        # limits per frame, for a stack and for an iterable
+        rgba = colormap.render_frames(stack, shared=False)
+        self.assertTrue(np.equal(rgba, separate).all())
+        out = np.empty((2, 3, 4), 'u1')
+        for i, rgba in enumerate(colormap.iter_frames(
+            stack, shared=False, out=out,
+        )):
+            self.assertIs(rgba, out)
+            self.assertTrue(np.equal(rgba, separate[i]).all())
+
+        # packed
+        rgba = colormap.render_frames(frames, packed=True)
+        self.assertEqual(rgba.shape, (4, 2, 3))
+        self.assertTrue(np.equal(rgba, colormap(stack, packed=True)).all())
+
     def test_data_repr(self):
         data = core.Data(data=(2, 3), limits=(1, 4))
         self.assertEqual(repr(data), '<Data: data 2,3; limits 1,4>')
@@ -332,6 +727,507 @@ class TestManager(unittest.TestCase):
         colormap = manager.get('jet')
         self.assertEqual(colormap.label([5, 6]), [5, 6])
 
+        # labels are only read for the locale that is used
+        labels = manager.get_labels('lc-wss')
+        locale = next(iter(labels))
+        self.assertIsInstance(labels.sources[locale], str)
+        labels.label([1], locale=locale)
+        self.assertIsInstance(labels.sources[locale], dict)
+
+    def test_manager_cache(self):
+        manager = colormaps.Manager(cache_size=2)
+        colormap = manager.get('jet')
+        self.assertIs(manager.get('jet'), colormap)
+        self.assertNotIn('jet', colormaps.registered)
+        self.assertIsNot(colormaps.Manager().get('jet'), colormap)
+        manager.get('Blues')
+        manager.get('Reds')
+        self.assertNotIn('jet', manager.cache)
+        self.assertEqual((manager.cache.hits, manager.cache.misses), (1, 3))
+
+        # tables cached by a colormap count towards its weight
+        colormap = manager.get('Reds')
+        nbytes = colormap.nbytes
+        colormap(np.arange(256, dtype='u1'), limits=(0, 255))
+        self.assertEqual(colormap.nbytes, nbytes + 256 * 4)
+        manager.get('Reds')
+        self.assertEqual(manager.cache.weights['Reds'], nbytes + 256 * 4)
+
+        # the default manager serves colormaps.get()
+        self.assertIsInstance(colormaps.get('jet'), core.GradientColormap)
+        self.assertIs(colormaps.get('jet'), colormaps.get('jet'))
+
+        # as do other managers, for colormaps they loaded that are in use
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, 'custom.json'), 'w') as f:
+                json.dump({'type': 'GradientColormap',
+                           'data': [(0, MASKED), (1, INVALID)]}, f)
+            colormap = colormaps.Manager(path).get('custom')
+            self.assertIs(colormaps.get('custom'), colormap)
+        finally:
+            shutil.rmtree(path)
+
+    def test_manager_async(self):
+        manager = colormaps.Manager()
+        load = manager.load
+        loaded = []
+
+        def counting_load(name):
+            loaded.append(name)
+            return load(name)
+
+        manager.load = counting_load
+
+        async def run():
+            first, second = await asyncio.gather(
+                manager.aget('jet'), manager.aget('jet'),
+            )
+            self.assertIs(first, second)
+            self.assertIs(await manager.aget('jet'), first)
+            await manager.preload(['jet', 'Blues', 'Reds'], concurrency=2)
+            with self.assertRaises(NameError):
+                await manager.aget('blabla')
+
+        asyncio.run(run())
+        self.assertEqual(sorted(loaded), ['Blues', 'Reds', 'jet'])
+        self.assertEqual(manager.futures, {})
+
+
+class TestManagerIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.path, 'data')
+        self.index_path = os.path.join(self.path, 'index.json')
+        for relpath in 'a', 'b/c':
+            os.makedirs(os.path.join(self.data_path, relpath))
+        for relpath in 'a/one.json', 'b/c/two.json':
+            with open(os.path.join(self.data_path, relpath), 'w') as f:
+                f.write('{}')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_index(self):
+        manager = colormaps.Manager(self.data_path, index_path=self.index_path)
+        self.assertEqual(manager.keys, [('a:one', 'one'), ('b:c:two', 'two')])
+        self.assertTrue(os.path.exists(self.index_path))
+
+        # warm start uses the index
+        mtime = os.stat(self.index_path).st_mtime_ns
+        manager = colormaps.Manager(self.data_path, index_path=self.index_path)
+        self.assertEqual(manager.keys, [('a:one', 'one'), ('b:c:two', 'two')])
+        self.assertEqual(os.stat(self.index_path).st_mtime_ns, mtime)
+
+        # changes are picked up
+        os.remove(os.path.join(self.data_path, 'a', 'one.json'))
+        shutil.rmtree(os.path.join(self.data_path, 'b', 'c'))
+        with open(os.path.join(self.data_path, 'b', 'three.json'), 'w') as f:
+            f.write('{}')
+        manager = colormaps.Manager(self.data_path, index_path=self.index_path)
+        self.assertEqual(manager.keys, [('b:three', 'three')])
+        self.assertEqual(sorted(manager.index), ['', 'a', 'b'])
+
+    def test_index_concurrent(self):
+        errors = []
+        barrier = threading.Barrier(8)
+
+        def build():
+            barrier.wait()
+            try:
+                colormaps.Manager(self.data_path, index_path=self.index_path)
+            except Exception as error:
+                errors.append(error)
+
+        for i in range(10):
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            threads = [threading.Thread(target=build) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(self.path)), ['data', 'index.json'])
+
+    def test_index_unwritable(self):
+        index_path = os.path.join(self.path, 'missing', 'index.json')
+        manager = colormaps.Manager(self.data_path, index_path=index_path)
+        self.assertEqual(len(manager.keys), 2)
+
+    def test_index_symlinks(self):
+        # symlinked directories are not followed, as by os.walk
+        os.symlink(self.data_path, os.path.join(self.data_path, 'a', 'loop'))
+        manager = colormaps.Manager(self.data_path)
+        self.assertEqual(manager.keys, [('a:one', 'one'), ('b:c:two', 'two')])
+
+    def test_index_invalid(self):
+        with open(self.index_path, 'w') as f:
+            f.write('nonsense')
+        manager = colormaps.Manager(self.data_path, index_path=self.index_path)
+        self.assertEqual(len(manager.keys), 2)
+        other_path = os.path.join(self.data_path, 'b')
+        manager = colormaps.Manager(other_path, index_path=self.index_path)
+        self.assertEqual(manager.keys, [('c:two', 'two')])
+        self.assertRaises(
+            ValueError,
+            colormaps.Manager,
+            self.data_path,
+            index_path=os.path.join(self.data_path, 'index.json'),
+        )
+
+
+class TestManagerRefresh(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in 'one', 'two', 'three':
+            self.write(name, (0, 0, 0, 255))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, color, mtime=None):
+        path = os.path.join(self.path, name + '.json')
+        with open(path, 'w') as f:
+            json.dump({'type': 'DiscreteColormap', 'data': [[1, color]]}, f)
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+    def test_refresh(self):
+        manager = colormaps.Manager(self.path)
+        one = manager.get('one')
+        manager.get('two')
+        self.assertEqual(manager.refresh(), [])
+
+        self.write('one', (255, 0, 0, 255), mtime=1)
+        os.remove(os.path.join(self.path, 'two.json'))
+        self.write('four', (0, 0, 0, 255))
+        self.assertEqual(manager.refresh(), ['four', 'one', 'two'])
+        self.assertIsNot(manager.get('one'), one)
+        self.assertEqual(manager.get('one')([1]).tolist(), [[255, 0, 0, 255]])
+        self.assertNotIn('two', manager.cache)
+        self.assertRaises(NameError, manager.get, 'two')
+        self.assertIn('four', manager.registered)
+
+        # unchanged entries are left alone
+        one = manager.get('one')
+        self.write('three', (0, 255, 0, 255), mtime=1)
+        self.assertEqual(manager.refresh(), [])
+        self.assertIs(manager.get('one'), one)
+
+    def test_refresh_swap(self):
+        # the old colormap stays cached while the new one is loaded
+        manager = colormaps.Manager(self.path)
+        one = manager.get('one')
+        load = manager.load
+        served = []
+
+        def load_and_get(name):
+            served.append(manager.cache.items.get(name))
+            return load(name)
+
+        manager.load = load_and_get
+        self.write('one', (255, 0, 0, 255), mtime=1)
+        self.assertEqual(manager.refresh(), ['one'])
+        self.assertEqual(served, [one])
+        self.assertIsNot(manager.get('one'), one)
+
+        # a colormap that fails to load is dropped
+        with open(os.path.join(self.path, 'one.json'), 'w') as f:
+            f.write('nonsense')
+        self.assertEqual(manager.refresh(), ['one'])
+        self.assertNotIn('one', manager.cache)
+
+    def test_watch(self):
+        manager = colormaps.Manager(self.path)
+        manager.get('one')
+        changes = []
+        watcher = manager.watch(interval=0.01, callback=changes.append)
+        self.write('one', (255, 0, 0, 255), mtime=1)
+        for i in range(500):
+            if changes:
+                break
+            time.sleep(0.01)
+        watcher.stop()
+        self.assertEqual(changes[0], ['one'])
+
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.bundle_path = os.path.join(self.path, 'bundle.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_bundle(self):
+        manager = colormaps.Manager()
+        manager.compile(self.bundle_path)
+        bundled = colormaps.Manager(bundle_path=self.bundle_path)
+        self.assertEqual(bundled.keys, manager.keys)
+        self.assertEqual(
+            sorted(bundled.registered), sorted(manager.registered),
+        )
+
+        data = {'values': np.linspace(-1, 2, 64).reshape(8, 8),
+                'no_data_value': 0.5}
+        for name in 'jet', 'su-world', 'Blues_r':
+            expected = manager.load(name)
+            colormap = bundled.load(name)
+            self.assertEqual(repr(colormap), repr(expected))
+            self.assertEqual(colormap.label([1, 2]), expected.label([1, 2]))
+            self.assertTrue(np.equal(colormap(data), expected(data)).all())
+            self.assertTrue(np.equal(
+                colormap(data, limits=(0, 1)), expected(data, limits=(0, 1)),
+            ).all())
+
+
+class TestFiles(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_render_file(self):
+        values = np.arange(24, dtype='i2').reshape(4, 6)
+        src = os.path.join(self.path, 'src.npy')
+        dst = os.path.join(self.path, 'dst.npy')
+        np.save(src, values)
+        colormap = gradient()
+        result = colormaps.render_file(
+            colormap, src, dst, no_data_value=5, chunk_size=1,
+        )
+        expected = colormap(dict(values=values, no_data_value=5))
+        self.assertEqual(result.tolist(), expected.tolist())
+        self.assertEqual(np.load(dst).tolist(), expected.tolist())
+
+    def test_render_file_raw(self):
+        values = np.linspace(0, 1, 24).reshape(4, 6)
+        src = os.path.join(self.path, 'src.raw')
+        dst = os.path.join(self.path, 'dst.raw')
+        values.tofile(src)
+        colormaps.render_file(
+            'jet', src, dst, dtype='f8', shape=(4, 6), packed=True,
+        )
+        self.assertEqual(
+            np.fromfile(dst, 'u4').reshape(4, 6).tolist(),
+            colormaps.Manager().get('jet')(values, packed=True).tolist(),
+        )
+        self.assertRaises(
+            ValueError, colormaps.render_file, 'jet', src, dst,
+        )
+
+
+class TestBlend(unittest.TestCase):
+    def test_divide(self):
+        values = np.arange(255 * 255 + 1, dtype='u2')
+        expected = np.floor(values / 255 + 0.5)
+        self.assertTrue(np.equal(blend.divide(values), expected).all())
+
+    def test_composite(self):
+        bottom = gradient(size=256)
+        top = discrete()
+        data = np.ma.masked_array(
+            np.arange(12).reshape(3, 4) % 3, mask=[[0, 0, 0, 1]] * 3,
+        )
+        layers = [(bottom, np.arange(12.).reshape(3, 4)),
+                  (top, data, None, 0.5)]
+        rgba = colormaps.composite(layers)
+        self.assertEqual(rgba.dtype, 'u1')
+
+        # float reference of straight alpha blending
+        below = bottom(layers[0][1]).astype('f8') / 255
+        above = top(data).astype('f8') / 255
+        above[..., 3] *= 0.5
+        alpha = above[..., 3:] + below[..., 3:] * (1 - above[..., 3:])
+        color = (above[..., :3] * above[..., 3:] +
+                 below[..., :3] * below[..., 3:] * (1 - above[..., 3:]))
+        expected = np.concatenate([color / alpha, alpha], axis=-1) * 255
+        self.assertLessEqual(np.abs(rgba - expected).max(), 2)
+
+        # blocks, threads and premultiplied output
+        self.assertTrue(np.equal(
+            colormaps.composite(layers, chunk_size=1, workers=2), rgba,
+        ).all())
+        premultiplied = colormaps.composite(layers, premultiplied=True)
+        self.assertEqual(premultiplied[..., 3].tolist(), rgba[..., 3].tolist())
+        self.assertRaises(
+            ValueError, colormaps.composite, [(bottom, [1, 2]), (top, [1])],
+        )
+
+
+class TestStatistics(unittest.TestCase):
+    def test_statistics(self):
+        state = np.random.RandomState(0)
+        values = state.normal(size=(100, 100))
+        values[0, 0] = np.nan
+        values[0, 1] = 9
+        statistics = colormaps.Statistics(stretch=(2, 98))
+        for block in values[:50], values[50:]:
+            statistics.update(dict(values=block, no_data_value=9))
+        valid = values[np.isfinite(values) & (values != 9)]
+        self.assertEqual(statistics.count, valid.size)
+        self.assertEqual(statistics.min, valid.min())
+        self.assertEqual(statistics.max, valid.max())
+        for q in 2, 50, 98:
+            self.assertAlmostEqual(
+                statistics.percentile(q), np.percentile(valid, q), places=2,
+            )
+        self.assertTrue(repr(statistics))
+
+        # merged statistics
+        merged = colormaps.Statistics(stretch=(2, 98))
+        for block in values[:50], values[50:]:
+            part = colormaps.Statistics()
+            part.update(np.ma.masked_equal(block, 9))
+            merged.merge(part)
+        self.assertEqual(merged.count, valid.size)
+        self.assertAlmostEqual(
+            merged.percentile(50), np.percentile(valid, 50), places=1,
+        )
+
+        # as limits source
+        colormap = gradient()
+        self.assertEqual(
+            colormap(values, limits=statistics).tolist(),
+            colormap(values, limits=statistics.get_limits()).tolist(),
+        )
+
+    def test_statistics_free(self):
+        values = np.arange(12, dtype='f4').reshape(3, 4)
+        statistics = colormaps.Statistics()
+        for block in [7], values[:1], values[1:], []:
+            statistics.update(block)
+        statistics.update(np.ma.masked_all(3))
+        colormap = gradient()
+        self.assertEqual(
+            colormap(values, limits=statistics).tolist(),
+            colormap(values).tolist(),
+        )
+        self.assertAlmostEqual(statistics.percentile(50), 6, places=1)
+        self.assertIsNone(colormaps.Statistics().get_limits())
+        self.assertRaises(ValueError, colormaps.Statistics, bins=3)
+
+    def test_statistics_constant(self):
+        statistics = colormaps.Statistics(bins=0)
+        statistics.update([3, 3])
+        self.assertEqual(statistics.percentile(50), 3)
+        statistics.update([4])
+        self.assertRaises(ValueError, statistics.percentile, 50)
+        statistics = colormaps.Statistics()
+        statistics.update([3, 3])
+        statistics.update([1, 5])
+        self.assertAlmostEqual(statistics.percentile(50), 3, places=2)
+
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        lru = cache.LRU(size=2)
+        self.assertEqual(lru.get('a', lambda: 1), 1)
+        self.assertEqual(lru.get('b', lambda: 2), 2)
+        self.assertEqual(lru.get('a', lambda: 3), 1)  # hit, 'b' oldest now
+        self.assertEqual(lru.get('c', lambda: 4), 4)
+        self.assertNotIn('b', lru)
+        self.assertIn('a', lru)
+        self.assertEqual((lru.hits, lru.misses), (1, 3))
+        self.assertTrue(repr(lru))
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+
+    def test_lru_nbytes(self):
+        lru = cache.LRU(size=10, nbytes=10, weigh=len)
+        lru.get('a', lambda: 'aaaa')
+        lru.get('b', lambda: 'bbbb')
+        lru.get('c', lambda: 'cccc')
+        self.assertEqual(list(lru.items), ['b', 'c'])
+        lru.get('d', lambda: 'd' * 20)  # the most recent item is kept
+        self.assertEqual(list(lru.items), ['d'])
+        self.assertEqual(lru.total, 20)
+
+        # items are weighed again on a hit
+        item = []
+        lru.get('e', lambda: item)
+        item.extend('e' * 5)
+        lru.get('e', lambda: None)
+        self.assertEqual(lru.total, 5)
+        self.assertEqual(lru.values(), [item])
+
+    def test_lru_single_flight(self):
+        lru = cache.LRU()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def build():
+            calls.append(None)
+            started.set()
+            release.wait()
+            return 'item'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(lru.get('key', build)),
+        ) for i in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['item'] * 4)
+        self.assertEqual(lru.misses, 1)
+
+        # failed builds are not cached and do not block
+        self.assertRaises(ZeroDivisionError, lru.get, 'error', lambda: 1 / 0)
+        self.assertEqual(lru.get('error', lambda: 2), 2)
+
+
+class TestInstrument(unittest.TestCase):
+    def test_recording(self):
+        colormap = gradient()
+        data = np.ma.masked_array([[1, 2], [3, 4]], [[0, 1], [0, 0]])
+        with instrument.recording() as records:
+            self.assertTrue(instrument.enabled)
+            colormap(data)
+        self.assertFalse(instrument.enabled)
+        colormap(data)  # not recorded
+        self.assertEqual(
+            [r['stage'] for r in records], ['mask', 'index', 'gather', 'call'],
+        )
+        self.assertEqual(records[0]['pixels'], 4)
+        self.assertEqual(records[0]['masked'], 1)
+        self.assertEqual(records[2]['nbytes'], 16)
+        self.assertEqual(records[3]['path'], 'render')
+        self.assertTrue(all(r['seconds'] >= 0 for r in records))
+
+        # lookup tables and manager loading
+        with instrument.recording() as records:
+            discrete()(np.arange(256, dtype='u1'))
+            colormaps.Manager().load('jet')
+        summary = instrument.summarize(records)
+        self.assertEqual(summary['table']['pixels'], 256)
+        self.assertEqual(summary['load']['count'], 1)
+        self.assertEqual(summary['build']['nbytes'], 1036)
+        self.assertEqual(summary['call']['pixels'], 256)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_compare(self):
+        result = benchmarks.run('sum', lambda: np.ones(16).sum(), pixels=16)
+        self.assertEqual(result['pixels'], 16)
+        self.assertGreater(result['pixels_per_second'], 0)
+        baseline = [dict(result, seconds=result['seconds'] / 2)]
+        (name, seconds, previous, ratio, regression), = benchmarks.compare(
+            [result], baseline,
+        )
+        self.assertEqual(name, 'sum')
+        self.assertAlmostEqual(ratio, 2)
+        self.assertTrue(regression)
+        self.assertEqual(benchmarks.compare([result], []), [])
+
 
 class TestUtils(unittest.TestCase):
     def test_cdict2config(self):